@@ -9,8 +9,15 @@ The ABC files can be augmented for Paverty
 A line that is "%p: v BB" means BB is the vocalist
 """
 #import itertools
+import gc
+import io
+import array
+import mmap
+import os
 import re
 import sys
+import pickle
+import hashlib
             
 def abcdict(ssx):
     "convert a list of songs to a header and a dictionary of songs lines"
@@ -53,7 +60,7 @@ def fixtitle(title):
     return ' '.join(ps)
 
 class Song:
-    pass
+    __slots__ = ()
 
 oldplines =[]
 class ABCsong(Song):
@@ -62,8 +69,13 @@ class ABCsong(Song):
     Note: the X: lines was trimmed from the front.
     No blank line at the end.
     Also, set index value for each ABC item - True unless %%index 0 is present
+    The positions of field lines (see tagcodes below) are indexed when the song is created
+    so the accessors don't rescan the lines. Derived values (key, rhythm group, digests) are remembered.
     """
+    __slots__ = ('xid', 'lines', 'index', 'attr', 'tagmap', '_key', '_rgroup', '_digest', '_idigest')
     patnoindex = re.compile(r'^\s*%%\s*index\s+[0NnFf]') # Allow 0, No or False
+    tagcodes = {'T':'T', 'K':'K', 'M':'M', 'R':'R', 'N':'N', 'W':'W', '%p':'p'} # field tags in the index
+    tagstarts = dict((t+':' if len(t)==1 else t, c) for t, c in tagcodes.items()) # by the first two characters of a line
     def __init__(self, plines, attrs=None):
         global oldplines
         # song/tunes must start with an X: line
@@ -78,23 +90,70 @@ class ABCsong(Song):
             assert False
         # dispose of any initial blank words lines ... they break things
         oldplines = plines
+        text = '\n'.join(plines) # looking in it first saves scanning most tunes' lines
         wpos = 0
-        for i, l in enumerate(plines):
-            if l.startswith('W:'):
-                wpos = i
-                wend = wpos
-                while wend<len(plines) and plines[wend]=='W:':
-                    wend+=1
-                break
+        if '\nW:' in text:
+            for i, l in enumerate(plines):
+                if l.startswith('W:'):
+                    wpos = i
+                    wend = wpos
+                    while wend<len(plines) and plines[wend]=='W:':
+                        wend+=1
+                    break
         lines = [x for x in (plines[:wpos]+plines[wend:] if wpos else plines)]
-        self.index = not any(ABCsong.patnoindex.match(x) for x in plines)
+        self.index = 'index' not in text or not any(ABCsong.patnoindex.match(x) for x in plines)
         self.xid = lines[0][2:].strip()
         self.lines = lines[1:] if lines[0].startswith('X:') else lines 
         self.attr = attrs
+        self.mkindex()
+        return
+        
+    def mkindex(self):
+        "index tag lines in one scan - must be called if self.lines changes"
+        # one character per line - the tag code or a space - so finding tag lines is a str.find() away
+        # most tunes have the same layout so the interned maps are shared - cheap for big libraries
+        starts = ABCsong.tagstarts
+        tmap = ''.join([starts.get(l[:2], ' ') for l in self.lines])
+        if 'p' in tmap: # %p lines need a : after the tag
+            tmap = ''.join(c if c!='p' or l[2:3]==':' else ' ' for c, l in zip(tmap, self.lines))
+        self.tagmap = sys.intern(tmap.rstrip())
+        self._key = self._rgroup = self._digest = self._idigest = None
+        return
+
+    def digest(self):
+        "a hash of the tune (Xid and lines) - the same in every run, so it can key cached HTML (see addsvg.py -i)"
+        if self._digest is None:
+            self._digest = hashlib.blake2b(('X:'+self.xid+'\n'+'\n'.join(self.lines)).encode(), digest_size=16).digest()
+        return self._digest
+
+    def idxdigest(self):
+        "digest() of what the indices use - Xid, %%index and the field lines in tagcodes (where they are)"
+        if self._idigest is None:
+            fields = '\n'.join(l for l, c in zip(self.lines, self.tagmap) if c!=' ')
+            self._idigest = hashlib.blake2b('\n'.join((self.xid, str(self.index), self.tagmap, fields)).encode(), digest_size=16).digest()
+        return self._idigest
+        
+    def tagpos(self, tag):
+        "line positions of the tag lines"
+        code, tmap = ABCsong.tagcodes[tag], self.tagmap
+        i = tmap.find(code)
+        while i>=0:
+            yield i
+            i = tmap.find(code, i+1)
+        return
+        
+    def __getstate__(self):
+        "compact pickle state (for the Songsets cache)"
+        return tuple(getattr(self, a) for a in ABCsong.__slots__)
+    
+    def __setstate__(self, state):
+        for a, v in zip(ABCsong.__slots__, state):
+            setattr(self, a, v)
         return
         
     def clean(self):
         self.lines = [l for l in self.lines if not l.startswith('%%newpage')]
+        self.mkindex()
         return self
     
     def id(self):
@@ -103,6 +162,8 @@ class ABCsong(Song):
     def taglines(self, tag):
         "all the lines that start with tag"
         tagx = tag.strip()+':'
+        if tag.strip() in ABCsong.tagcodes:
+            return (self.lines[i].removeprefix(tagx).strip() for i in self.tagpos(tag.strip()))
         return (l.removeprefix(tagx).strip() for l in self.lines if l.startswith(tagx))
     
     def tagline(self, tag):
@@ -114,15 +175,15 @@ class ABCsong(Song):
     
     def titles(self, all=False, fix=False, drop=False):
         "title lines - lines that start with T: up to first K: line (if not all)"
-        for line in self.lines:
-            if line.startswith('T:'):
-                t = line[2:].strip()
-                if drop and t.startswith('-'): # ignore titles that start with '-'
-                    continue
-                yield fixtitle(t) if fix else t.strip()
-                # yield retitlefix.sub(r'\2 \1', t) if fix else t
-            if not all and line.startswith('K:'):
+        kpos = self.tagmap.find('K')
+        for i in self.tagpos('T'):
+            if not all and 0<=kpos<i:
                 break
+            t = self.lines[i][2:].strip()
+            if drop and t.startswith('-'): # ignore titles that start with '-'
+                continue
+            yield fixtitle(t) if fix else t.strip()
+            # yield retitlefix.sub(r'\2 \1', t) if fix else t
         return
     
     def alltitles(self, fix=False, drop=False):
@@ -144,28 +205,37 @@ class ABCsong(Song):
         # maybe should include w: as well
         return self.taglines('W')
     
+    ktrim = (('maj', ''), ('major', ''), ('minor', 'm'), ('min', 'm'), ('dorian', 'dor'))
     def key(self):
         "get the first key - first K: tag"
-        trim = (('maj', ''), ('major', ''), ('minor', 'm'), ('min', 'm'), ('dorian', 'dor'))
-        for ll in self.taglines('K'):
-            if not ll:
-                return ll
-            l = ll.split()[0] # strip off any extra stuff like clef= ...
-            for x, z in trim:
+        if self._key is None and 'K' in self.tagmap:
+            self._key = ABCsong.keyname(self.tagline('K'))
+        return self._key
+
+    @staticmethod
+    def keyname(l):
+        "the key for a K: value"
+        if l:
+            l = l.split()[0] # strip off any extra stuff like clef= ...
+            for x, z in ABCsong.ktrim:
                 if l.endswith(x):
                     l = l[:-len(x)]+z
-            return l
-        return None
+        return l
     
     def mbody(self):
         "True if anything follows K: ... this is more than a place holder"
-        kno = next(i for i, lx in enumerate(self.lines) if lx.startswith('K:'))
+        kno = next(self.tagpos('K'))
         return kno+1<len(self.lines)
     
     def linesstr(self):
         "the lines of the song - as a string"
         return ''.join(map(lambda x:x+"\n", self.lines))
         
+    def notes(self, bars=None):
+        "the notes after K: - (steps, semitones, lengths) see abcnotes() - only the first bars if bars is given"
+        kpos = self.tagmap.find('K')
+        return abcnotes(self.lines[kpos+1:] if kpos>=0 else [], self.lines[kpos][2:] if kpos>=0 else '', bars)
+
     def vocalist(self):
         "%p: v BB style lines in Paverty ABC files"
         for l in self.taglines('%p'):
@@ -191,11 +261,19 @@ class ABCsong(Song):
                   ('3/4', 'waltz')]
                   )
     
+    rebars = re.compile(r'\s*\d+[ -]bars*\s*')
+    
     def rhythmgroup(self):
         "define a rhythm group for each song - derived from R: or M: tag"
+        if self._rgroup is None:
+            self._rgroup = self.rhythmgroupx()
+        return self._rgroup
+    
+    def rhythmgroupx(self):
+        "work out the rhythm group - see rhythmgroup()"
         rs = self.tagline('R')
         if rs:
-            rs = re.sub(r'\s*\d+[ -]bars*\s*', '', rs)   # ignore bar count
+            rs = ABCsong.rebars.sub('', rs)   # ignore bar count
         else:
             mx = self.tagline('M')
             assert mx, "song {xid} missing both R: and M: lines".format(xid=self.xid)
@@ -206,49 +284,595 @@ class ABCsong(Song):
 
         return ABCsong.rd[rs]
 
+class LazyABCsong(ABCsong):
+    """
+    an ABCsong that is only parsed when it is used - see Songsets(lazy=True)
+    It is a span (start to end) of the library's text. Fields (titles, key, tag lines etc.) are found in
+    the text when they are asked for, and the tune is only made into lines (an ABCsong) when they
+    are used - e.g. linesstr(). The answers are always the same as ABCsong's.
+    """
+    __slots__ = ('text', 'start', 'end', 'midi', 'song')
+    patnoindex = re.compile(r'^[^\S\n]*%%[^\S\n]*index[^\S\n]+[0NnFf]', flags=re.M) # ABCsong.patnoindex over many lines
+    retags = {} # tag -> regular expression for its lines
+
+    def __init__(self, text, start, end, xid, midi=True):
+        self.text, self.start, self.end, self.midi = text, start, end, midi
+        self.xid, self.attr = xid, None
+        self.song = self._key = self._rgroup = None
+        return
+
+    def full(self):
+        "the ABCsong for the tune - as Songsets.parse() makes it"
+        if not self.song:
+            self.song = ABCsong(spanlines(self.text, self.start, self.end, self.midi))
+            self.text = None # not needed now
+        return self.song
+
+    lines = property(lambda self:self.full().lines, lambda self, v:setattr(self.full(), 'lines', v))
+    tagmap = property(lambda self:self.full().tagmap, lambda self, v:setattr(self.full(), 'tagmap', v))
+
+    def mkindex(self):
+        self.full().mkindex()
+        self._key = self._rgroup = None
+        return
+
+    def digest(self):
+        return self.full().digest()
+
+    def idxdigest(self):
+        return self.full().idxdigest()
+
+    @property
+    def index(self):
+        if self.song:
+            return self.song.index
+        return self.text.find('index', self.start, self.end)<0 or not LazyABCsong.patnoindex.search(self.text, self.start, self.end)
+
+    def __reduce__(self):
+        "pickled as an ABCsong"
+        return ABCsong.__new__, (ABCsong,), self.full().__getstate__()
+
+    def taglines(self, tag):
+        tag = tag.strip()
+        if self.song or tag=='W' or tag.startswith('%%MIDI'): # blank W: lines are dropped and %%MIDI lines may be
+            return self.full().taglines(tag)
+        return self.tagtext(tag, self.end)
+
+    def tagtext(self, tag, end):
+        "the tag lines (as taglines()) up to end - found in the text"
+        p = LazyABCsong.retags.get(tag)
+        if not p:
+            p = LazyABCsong.retags[tag] = re.compile('\n'+re.escape(tag)+':(.*)') # starting with a newline makes the search quick
+        nl = self.text.find('\n', self.start, end) # not the X: line
+        return (t.strip() for t in p.findall(self.text, nl, end)) if nl>=0 else iter(())
+
+    def titles(self, all=False, fix=False, drop=False):
+        if self.song:
+            return self.song.titles(all=all, fix=fix, drop=drop)
+        k = -1 if all else self.text.find('\nK:', self.start, self.end) # up to the first K:
+        ts = self.tagtext('T', self.end if k<0 else k)
+        return (fixtitle(t) if fix else t for t in ts if not (drop and t.startswith('-')))
+
+    def key(self):
+        if self.song:
+            return self.song.key()
+        if self._key is None:
+            l = self.tagline('K')
+            if l is not None:
+                self._key = ABCsong.keyname(l)
+        return self._key
+
+# ABC notes - for finding tunes by their notes (see incipits.py)
+NOTEUNIT = 12 # note lengths are in 1/NOTEUNIT of the L: unit - so triplets and halves are whole numbers
+letterstep = dict((c, n) for n, c in enumerate('CDEFGAB'))
+lettersemi = dict(zip('CDEFGAB', (0, 2, 4, 5, 7, 9, 11)))
+letterfifths = dict(zip('FCGDAEB', range(-1, 6)))
+modefifths = {'maj':0, 'ion':0, 'm':-3, 'min':-3, 'aeo':-3, 'dor':-2, 'mix':-1, 'lyd':1, 'phr':-4, 'loc':-5}
+rekey = re.compile(r'\s*([A-G])([#b]?)\s*([A-Za-z]*)')
+renotes = re.compile(r"""
+    %.*|"[^"]*"|![^!]*!|\+[^+]*\+|\{[^}]*\}       # comments, chord symbols, decorations, grace notes
+  | \[(?P<field>[A-Za-z]):(?P<fval>[^\]]*)\]         # inline field - [K:G]
+  | (?P<bar>:*\[?\|[|\]]*:*\d*|\[\d+|::)            # bar lines and repeat endings
+  | (?P<chord>\[)|\](?P<endchord>\d*/*\d*)
+  | \((?P<tuplet>\d)(?::\d*){0,2}
+  | (?P<broken>[<>]+)
+  | (?P<tie>-)
+  | (?P<acc>\^\^|\^|__|_|=)?(?P<note>[A-Ga-g])(?P<oct>[,']*)(?P<len>\d*/*\d*)
+  | [zxZX](?P<rest>\d*/*\d*)
+""", re.X)
+
+def keysig(k):
+    """
+    key signature and tonic for a K: value, e.g. 'D', 'Ador', 'F#m', 'Bb mixolydian'
+    returns ({letter: semitones}, tonic letter, tonic semitones above C) - K:none, K:HP etc. are C
+    """
+    m = rekey.match(k or '')
+    if not m:
+        return {}, 'C', 0
+    letter, acc, mode = m.groups()
+    mode = mode.lower()
+    fifths = letterfifths[letter]+{'#':7, 'b':-7}.get(acc, 0)+modefifths.get(mode if mode=='m' else mode[:3], 0)
+    fifths = max(-7, min(7, fifths))
+    sig = dict((c, 1) for c in 'FCGDAEB'[:fifths]) if fifths>0 else dict((c, -1) for c in 'BEADGCF'[:-fifths])
+    return sig, letter, (lettersemi[letter]+{'#':1, 'b':-1}.get(acc, 0))%12
+
+def notelen(s):
+    "the length of a note (in L: units) from its ABC suffix - e.g. '', '2', '/', '3/2', '//'"
+    num, slashes, den = re.match(r'(\d*)(/*)(\d*)', s).groups()
+    return int(num or 1)/(int(den) if den else 2**len(slashes))
+
+def abcnotes(lines, k='', bars=None):
+    """
+    the notes of ABC tune body lines (after K:) with K: value k
+    returns three arrays - each note's pitch in diatonic steps (letters) and in semitones above the tonic,
+    and its length (in 1/NOTEUNIT of the L: unit).
+    Steps don't depend on the key signature, so they match when a tune is transposed (or typed without it).
+    Rests, chord symbols, decorations and grace notes are skipped. A chord is its top note.
+    Tied notes are one note. bars stops after that many bars (a pickup counts as a bar).
+    """
+    sig, tonic, tsemi = keysig(k)
+    tstep = letterstep[tonic]
+    steps, semis, lens = array.array('b'), array.array('b'), array.array('H')
+    accs = {} # accidentals in this bar
+    nbars, chord, tie, broken, tuplet = 0, None, False, 1, []
+    def add(step, semi, ln):
+        nonlocal tie, broken
+        if tie and steps and semis[-1]==semi: # tied to the last note
+            lens[-1] = min(65535, lens[-1]+round(ln*NOTEUNIT))
+        else:
+            ln = ln*broken*(tuplet.pop() if tuplet else 1)
+            steps.append(max(-128, min(127, step)))
+            semis.append(max(-128, min(127, semi)))
+            lens.append(max(1, min(65535, round(ln*NOTEUNIT))))
+        tie, broken = False, 1
+        return
+    for line in lines:
+        if line[1:2]==':' and line[:1].isalpha(): # a field line - only K: matters
+            if line[0]=='K':
+                sig, tonic, tsemi = keysig(line[2:]) # steps stay relative to the first tonic
+            continue
+        if line.startswith('%'):
+            continue
+        for m in renotes.finditer(line):
+            g = m.lastgroup # the last group in the alternative that matched
+            if g=='len': # a note
+                c = m.group('note')
+                octave = (1 if c.islower() else 0)+m.group('oct').count("'")-m.group('oct').count(',')
+                c = c.upper()
+                acc = m.group('acc')
+                if acc:
+                    accs[c, octave] = {'^^':2, '^':1, '__':-2, '_':-1, '=':0}[acc]
+                step = letterstep[c]+7*octave-tstep
+                semi = lettersemi[c]+12*octave+accs.get((c, octave), sig.get(c, 0))-tsemi
+                ln = notelen(m.group('len'))
+                if chord is not None:
+                    chord.append((semi, step, ln))
+                else:
+                    add(step, semi, ln)
+            elif g=='chord':
+                chord = []
+            elif g=='endchord' and chord is not None:
+                if chord:
+                    semi, step, ln = max(chord) # top note
+                    add(step, semi, chord[0][2]*notelen(m.group('endchord')))
+                chord = None
+            elif g=='bar':
+                accs = {}
+                if steps:
+                    nbars += 1
+                    if bars and nbars>=bars:
+                        return steps, semis, lens
+            elif g=='tie':
+                tie = True
+            elif g=='broken' and lens:
+                b = 2-0.5**len(m.group('broken')) # > 1.5, >> 1.75
+                if m.group('broken')[0]=='>':
+                    lens[-1] = round(lens[-1]*b)
+                    broken = 2-b
+                else:
+                    lens[-1] = max(1, round(lens[-1]*(2-b)))
+                    broken = b
+            elif g=='tuplet':
+                p = int(m.group('tuplet'))
+                q = {2:3, 3:2, 4:3, 6:2, 8:3}.get(p, 2)
+                tuplet = [q/p]*p
+            elif g=='fval' and m.group('field')=='K':
+                sig, tonic, tsemi = keysig(m.group('fval'))
+    return steps, semis, lens
+
+resetpat = re.compile(r'^%%\s*(newpage|sep)$', flags=re.IGNORECASE) # set separator line (trailing space removed)
+
+def abcchunks(src, midi=True):
+    """
+    Tokenise an ABC library in a single pass over its lines (e.g. an open file).
+    Yields a list of lines for each blank-line separated chunk (header or song/tune)
+    and None for each set separator (%%newpage or %%sep).
+
+    Trailing spaces are removed from all lines. Any number of blank lines can separate chunks.
+    %%begintext to %%endtext blocks (the lines may be indented) are kept inside their chunk, even if
+    they contain blank lines. Songsets uses textchunks() - the same chunks, made more quickly.
+    """
+    chunk, intext = [], False
+    for line in src:
+        line = line.rstrip('\n').rstrip(' \t') # remove trailing space in all lines
+        if not midi and line.startswith('%%MIDI'):
+            continue # remove all MIDI lines - not able to play
+        if intext:
+            chunk.append(line)
+            intext = not line.lstrip().startswith('%%end')
+        elif not line:
+            if chunk:
+                yield chunk
+                chunk = []
+        elif resetpat.match(line):
+            if chunk:
+                yield chunk
+                chunk = []
+            yield None
+        else:
+            if not chunk:
+                line = line.lstrip()
+            chunk.append(line)
+            intext = line.lstrip().startswith('%%begintext')
+    if chunk:
+        yield chunk
+    return
+
+# the lines abcchunks() splits at (after their newline) - blank, set separator and %%begintext
+# (maybe indented). Starting with a newline makes the search quick.
+respanevent = re.compile(r'\n(?:(?P<blank>[ \t]*)(?=\n|\Z)|%%[^\S\n]*(?i:newpage|sep)[ \t]*(?=\n|\Z)|(?P<text>[^\S\n]*%%begintext))')
+reendtext = re.compile(r'^[^\S\n]*%%end', flags=re.M)
+
+def abcspans(text):
+    """
+    abcchunks() for the whole text of an ABC library - without making the lines
+    text must start with a newline (before the first line) - see Songsets.parselazy()
+    Yields (start, end) offsets in text for each chunk (end is the end of its last line, before the newline)
+    and None for each set separator. A regular expression finds the lines to split at, so the lines
+    in between are not looked at.
+    """
+    pos = start = 1 # pos is where the next line to look at starts and start is where the next chunk starts
+    size = len(text)
+    for m in respanevent.finditer(text):
+        ls = m.start()+1
+        if ls<pos: # in a %%begintext block
+            continue
+        if m.group('text'): # %%begintext - to the %%end line
+            e = reendtext.search(text, m.end())
+            e = text.find('\n', e.start()) if e else -1
+            if e<0:
+                break
+            pos = e+1
+            continue
+        if ls>start:
+            yield start, ls-1
+        if m.group('blank') is None: # a set separator
+            yield None
+        start = pos = m.end()+1
+    if start<size: # a %%begintext block to the end
+        yield start, size-1 if text.endswith('\n') else size
+    return
+
+def spanlines(text, start, end, midi=True):
+    "the lines of a chunk that abcspans() found - as abcchunks() makes them"
+    lines = [l.rstrip(' \t') for l in text[start:end].split('\n')]
+    if not midi:
+        lines = [l for l in lines if not l.startswith('%%MIDI')]
+    if lines:
+        lines[0] = lines[0].lstrip()
+    return lines
+
+def textchunks(text, midi=True):
+    "abcchunks() for the whole text of an ABC library (after a newline) - quicker as abcspans() finds the chunks"
+    for span in abcspans(text):
+        if span is None:
+            yield None
+            continue
+        lines = spanlines(text, *span, midi=midi)
+        if lines: # not only MIDI lines
+            yield lines
+    return
+
+PARSER = 3 # Songsets parser version - change it when parsing changes so old cache files are not used
+
+def cachename(fn, ext):
+    "cache file name for ABC file fn - kept in __abccache__ (like __pycache__) beside the ABC file"
+    d, bn = os.path.split(os.path.abspath(fn))
+    return os.path.join(d, '__abccache__', bn+ext)
+
+def loadcache(cfn, key):
+    "cached data for cfn if its key matches - otherwise None (stale, corrupt or missing)"
+    gcon = gc.isenabled()
+    gc.disable() # lots of small objects - the garbage collector just slows loading
+    try:
+        with open(cfn, 'rb') as src:
+            ckey, data = pickle.load(src)
+    except Exception: # anything wrong with the cache file means it is rebuilt
+        return None
+    finally:
+        if gcon:
+            gc.enable()
+    return data if ckey==key else None
+
+def savecache(cfn, key, data):
+    "write a cache file - quietly give up if that is not possible"
+    tmp = cfn+'.tmp'
+    try:
+        os.makedirs(os.path.dirname(cfn), exist_ok=True)
+        with open(tmp, 'wb') as dst:
+            pickle.dump((key, data), dst, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cfn) # never leave a partly written cache file
+    except OSError:
+        pass
+    return
+
 class Songsets:
 
-    def __init__(self, fn, midi=True):
+    def __init__(self, fn, midi=True, cache=True, lazy=False, reuse=False):
         """
         Read an ABC file whose name is fn
         
         Split file into songs/tunesets. These are separated by "\n%%newpage\n" or %%sep
         File is split into self.hdr and self.sets
 
-        It attempts to manage %%begintext to %%endtext that may contain blank lines.
+        The file is read in one pass (see textchunks() above) which manages %%begintext to %%endtext
+        blocks that may contain blank lines.
         The ABC file may contain isolated X: lines (as placeholders for new tunes)
+
+        If cache is True, the parsed library (with each tune's key and rhythm group) is kept in a cache file.
+        It is used while the ABC file's size, mtime and content (and the parser version) are unchanged.
+        self.cached says if the cache was used.
+
+        If lazy is True, the tunes are LazyABCsongs - only parsed as much as they are used - and the
+        cache is not used. That is quicker (and takes less memory) for jobs that only need some fields.
+
+        If reuse is True (and lazy is not), the file is read as reload() reads it, so later reloads only
+        parse new and edited tunes (watch mode) - the cache is written but not read.
         """
-        
-        with open(fn, 'rt') as src:
-            orig = src.read()+'\n' # extra newline fixes final %%newpage
-            if not midi:
-                orig = re.sub("\n%%MIDI.*\n", "\n", orig) # remove all MIDI lines - not able to play
-            orig = re.sub(r'[ \t]+\n', '\n', orig) # remove trailing space in all lines
-            txtpat = re.compile(r'%%begintext(([^%]|%(?!%end))*)', flags=re.MULTILINE)
-            txtblks = txtpat.findall(orig)                  # find and remember all %%(begin|end)text blocks
-            lines = txtpat.subn('%%begintextx', orig)[0]    # replace all text blocks
-            subpat = re.compile(r'%%begintextx')
-            def songfix(s):
-                "put text-blocks back into songs - must be called in order"
-                while(subpat.match(s)):
-                    s=subpat.sub(txtblks.pop(0)[0], s)
-                return s
-            setpat = re.compile(r'\n%%\s*(newpage|sep)\s*\n', flags=re.IGNORECASE|re.UNICODE|re.MULTILINE)
-            settmp = setpat.split(lines)[0::2]
-            inp = [z for z in map(lambda x: x.strip(), settmp) if z]
-
-        if inp and inp[0].startswith("%abc"): # deal with ABC header if there is one
-            hdr, inp[0] = inp[0].split("\n\n", 1)
-            self.hdr = hdr.splitlines()
-        else:
+        self.fn, self.midi, self.cache, self.lazy = fn, midi, cache, lazy
+        self.cached = False
+        self.known = None # see reload()
+        if lazy:
+            with open(fn, 'rt') as src:
+                self.parselazy('\n'+src.read(), midi)
+            return
+        if reuse:
+            self.reload()
+            return
+        if not cache:
+            with open(fn, 'rt') as src:
+                self.parse('\n'+src.read(), midi)
+            return
+        with open(fn, 'rb') as src:
+            data = src.read()
+            st = os.fstat(src.fileno())
+        key = (PARSER, midi, st.st_size, st.st_mtime_ns, hashlib.sha256(data).hexdigest())
+        cfn = cachename(fn, ('' if midi else '.nomidi')+'.sets')
+        cached = loadcache(cfn, key)
+        if cached:
+            self.hdr, self.sets = cached
+            self.cached = True
+            return
+        self.parse('\n'+io.TextIOWrapper(io.BytesIO(data)).read(), midi)
+        for s in self.abcs(): # remember derived values in the cache as well
+            s.key()
+            s.digest()
+            s.idxdigest()
+            try:
+                s.rhythmgroup()
+            except AssertionError: # only fails if the rhythm group is used
+                pass
+        savecache(cfn, key, (self.hdr, self.sets))
+        return
+
+    def reload(self):
+        """
+        read the ABC file again (e.g. after it has been edited) - used by watch mode (see addbooks.py)
+        Tunes whose lines have not changed are reused (with their key and rhythm group) so only new
+        and edited tunes are parsed. The first reload parses everything.
+        """
+        if self.lazy:
+            with open(self.fn, 'rt') as src:
+                self.parselazy('\n'+src.read(), self.midi)
+            return self
+        with open(self.fn, 'rb') as src:
+            data = src.read()
+            st = os.fstat(src.fileno())
+        self.parse('\n'+io.TextIOWrapper(io.BytesIO(data)).read(), self.midi, known=self.known if self.known else {})
+        self.cached = False
+        if self.cache:
+            for s in self.abcs():
+                s.key()
+                s.digest()
+                s.idxdigest()
+                try:
+                    s.rhythmgroup()
+                except AssertionError:
+                    pass
+            key = (PARSER, self.midi, st.st_size, st.st_mtime_ns, hashlib.sha256(data).hexdigest())
+            savecache(cachename(self.fn, ('' if self.midi else '.nomidi')+'.sets'), key, (self.hdr, self.sets))
+        return self
+
+    def parse(self, text, midi, known=None):
+        """
+        parse the text of an ABC library (after a newline) into self.hdr and self.sets - see textchunks()
+        known maps (tuples of) tune lines to ABCsongs from a previous parse - they are reused (see reload())
+        """
+        self.hdr = None
+        self.sets = []
+        sx, first = [], True
+        newknown = None if known is None else {}
+        for chunk in textchunks(text, midi=midi):
+            if chunk is None: # end of set
+                if sx:
+                    self.sets.append(sx)
+                    sx = []
+                continue
+            if first and chunk[0].startswith("%abc"):
+                self.hdr = chunk # deal with ABC header if there is one
+            elif len(chunk)>1: # drop empty X: songs - they are fillers for later use
+                if known is None:
+                    sx.append(ABCsong(chunk))
+                else:
+                    k = tuple(chunk)
+                    song = known.get(k)
+                    newknown[k] = song = song if song else ABCsong(chunk)
+                    sx.append(song)
+            first = False
+        if sx:
+            self.sets.append(sx)
+        if self.hdr is None:
             self.hdr = "%abc-2.1" # an assumption!
-        sss = ([songfix(x).strip().splitlines() for x in xs.strip().split('\n\n')] for xs in inp if xs)
-        # fails with multiple blank lines between songs - should use groupby()
-        # drop empty X: songs - they are fillers for later use
-        self.sets = [[ABCsong(x) for x in ss if len(x)>1] for ss in sss if len(ss)] # drop empty sets and tunes
+        if known is not None:
+            self.known = newknown
         
         return
     
+    def parselazy(self, text, midi):
+        "parse() for lazy Songsets - the text of the library (after a newline) is split into LazyABCsongs (see abcspans())"
+        self.hdr = None
+        self.sets = []
+        sx, first = [], True
+        for span in abcspans(text):
+            if span is None: # end of set
+                if sx:
+                    self.sets.append(sx)
+                    sx = []
+                continue
+            start, end = span
+            nl = text.find('\n', start, end)
+            if nl>=0 and text.startswith('X:', start) and (midi or not text.startswith('%%MIDI', nl+1)):
+                sx.append(LazyABCsong(text, start, end, text[start+2:nl].strip(), midi))
+            else: # the header, an empty X: song, a bad tune (ABCsong reports it) or one that may be empty without its MIDI lines
+                chunk = next(abcchunks(io.StringIO(text[start:end+1]), midi=midi), []) # as parse() - with its newline
+                if first and chunk and chunk[0].startswith("%abc"):
+                    self.hdr = chunk
+                elif len(chunk)>1:
+                    sx.append(ABCsong(chunk))
+            first = False
+        if sx:
+            self.sets.append(sx)
+        if self.hdr is None:
+            self.hdr = "%abc-2.1" # an assumption!
+        return
+
     def abcs(self):
         "flatten the sets to a list of abcs"
         return [s for ss in self.sets for s in ss]
+
+XIDX = 3 # XidIndex file version - change it when XidIndex.scan() changes
+resetpatb = re.compile(rb'^%%\s*(newpage|sep)$', flags=re.IGNORECASE) # resetpat for bytes
+
+class XidIndex:
+    """
+    Random access to the tunes in an ABC library by Xid - without parsing the whole library
+
+    The byte offsets of each tune (and of the header) and the set each tune is in are found in one
+    pass over the file (see scan() - it splits the file the same way as abcchunks() and Songsets).
+    They are kept in a sidecar file in __abccache__ (see cachename()) and used while the ABC file's
+    size and mtime are unchanged. If they change but the content (sha256) has not, the offsets are kept.
+    Tunes are read from a memory-mapped copy of the file when they are asked for.
+
+    Like abcdict(), the last tune with an Xid wins when Xids are repeated. An X: line with only %%MIDI
+    lines is an empty placeholder (as Songsets(midi=False) sees it) - it is not indexed.
+    self.sets is the Xids in each set. self.cached says if the sidecar file was used.
+    """
+    def __init__(self, fn, cache=True):
+        self.fn = fn
+        self.cached = False
+        self.src = open(fn, 'rb')
+        st = os.fstat(self.src.fileno())
+        self.buf = mmap.mmap(self.src.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+        cfn = cachename(fn, '.xidx')
+        cached = loadcache(cfn, XIDX) if cache else None
+        if cached and cached['stat']==(st.st_size, st.st_mtime_ns):
+            self.cached = True
+        else:
+            h = hashlib.sha256(self.buf).hexdigest()
+            if cached and cached['sha256']==h: # touched but not changed
+                self.cached = True
+            else:
+                cached = self.scan()
+                cached['sha256'] = h
+            cached['stat'] = (st.st_size, st.st_mtime_ns)
+            if cache:
+                savecache(cfn, XIDX, cached)
+        self.hdrpos, self.xids, self.sets = cached['hdr'], cached['xids'], cached['sets']
+        return
+
+    def scan(self):
+        "one pass over the file - the offsets of the header and each tune, and the Xids in each set"
+        buf, xids, sets = self.buf, {}, []
+        hdr, sx, first = None, [], True
+        chunk = None # [start, end, first line, number of lines that are not %%MIDI]
+        def endchunk():
+            nonlocal hdr, first
+            if first and chunk[2].startswith(b'%abc'):
+                hdr = (chunk[0], chunk[1])
+            elif chunk[3]>1: # empty X: songs (maybe with %%MIDI lines) are dropped - as in Songsets(midi=False)
+                xid = chunk[2][2:].strip().decode()
+                xids[xid] = (chunk[0], chunk[1], len(sets))
+                sx.append(xid)
+            first = False
+            return
+        intext, pos, size = False, 0, len(buf)
+        while pos<size:
+            nl = buf.find(b'\n', pos)
+            end = size if nl<0 else nl+1
+            line = buf[pos:end].rstrip(b'\r\n').rstrip(b' \t')
+            if intext:
+                chunk[1], chunk[3] = end, chunk[3]+(not line.startswith(b'%%MIDI'))
+                intext = not line.lstrip().startswith(b'%%end')
+            elif not line:
+                if chunk:
+                    endchunk()
+                    chunk = None
+            elif resetpatb.match(line):
+                if chunk:
+                    endchunk()
+                    chunk = None
+                if sx:
+                    sets.append(sx)
+                    sx = []
+            else:
+                if chunk:
+                    chunk[1], chunk[3] = end, chunk[3]+(not line.startswith(b'%%MIDI'))
+                else:
+                    line = line.lstrip()
+                    chunk = [pos, end, line, 1]
+                intext = line.lstrip().startswith(b'%%begintext')
+            pos = end
+        if chunk:
+            endchunk()
+        if sx:
+            sets.append(sx)
+        return {'hdr':hdr, 'xids':xids, 'sets':sets}
+
+    def __contains__(self, xid):
+        return xid in self.xids
+
+    def __len__(self):
+        return len(self.xids)
+
+    def chunk(self, start, end, midi=True):
+        "the lines of the file between the offsets - see abcchunks()"
+        return next(abcchunks(io.TextIOWrapper(io.BytesIO(self.buf[start:end])), midi=midi), [])
+
+    def hdr(self, midi=True):
+        "the ABC header lines"
+        return self.chunk(*self.hdrpos, midi=midi) if self.hdrpos else ["%abc-2.1"]
+
+    def song(self, xid, midi=True):
+        "the ABCsong for xid (KeyError if it is not in the library)"
+        start, end, n = self.xids[xid]
+        return ABCsong(self.chunk(start, end, midi=midi))
+
+    def setof(self, xid):
+        "the Xids in the set that xid is in"
+        return self.sets[self.xids[xid][2]]
+
+    def close(self):
+        if self.buf:
+            self.buf.close()
+        self.src.close()
+        return
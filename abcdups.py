@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Find tunes that are in ABC libraries more than once - e.g. under different Xids and titles when
+libraries are merged
+
+    python3 abcdups.py session.abc band.abc festival.abc
+    python3 abcdups.py -t 0.7 PBBtunes.abc
+
+Tunes are compared by their notes (ABClib.abcnotes() - bar lines, decorations, chord symbols and
+grace notes are ignored): the steps between notes and their rhythm are cut into overlapping runs of
+SHINGLE notes, and tunes with most of the same runs are duplicates - in any key, with or without
+repeats written out. Titles (ABClib.sorttitle()) help: tunes with a title in common need fewer runs
+in common.
+
+Comparing every pair of tunes is too slow for big libraries, so each tune gets a MinHash signature
+(one permutation hashing - NHASH minimums of the runs' hashes) and only tunes whose signatures
+have a band (ROWS minimums) in common are compared (locality sensitive hashing). The time taken
+grows with the number of tunes, not pairs.
+Signatures are kept in __abccache__ beside each ABC file by a hash of each tune's lines, so only
+new and edited tunes are signed when the command is run again.
+
+@author: Bob Buckley
+"""
+
+import re
+import sys
+import time
+import array
+import hashlib
+import argparse
+import collections
+
+import ABClib
+
+DUPS = 1 # signature cache version - change it when signatures (or ABClib.abcnotes()) change
+SHINGLE = 5 # notes in each run
+NHASH = 64 # minimums in a signature
+ROWS = 4 # minimums in each LSH band - NHASH/ROWS bands, pairs that are about 50% the same are found
+MAXBUCKET = 200 # bands shared by more tunes than this are too common to say anything (e.g. scales)
+MASK = (1<<64)-1
+
+def shingles(steps, lens):
+    "hashes of the runs of SHINGLE notes - steps between the notes and lengths (relative to the shortest)"
+    iv = bytes((b-a)&0xff for a, b in zip(steps, steps[1:]))
+    hs = set()
+    for i in range(len(lens)-SHINGLE+1):
+        ls = lens[i:i+SHINGLE]
+        m = min(ls)
+        run = iv[i:i+SHINGLE-1]+bytes(min(255, l//m) for l in ls)
+        hs.add(int.from_bytes(hashlib.blake2b(run, digest_size=8).digest(), 'little'))
+    return hs
+
+def signature(hs):
+    "MinHash signature of a set of hashes (one permutation hashing) - bytes, or None if there are none"
+    if not hs:
+        return None
+    mins = [MASK]*NHASH
+    for h in hs:
+        b, v = h%NHASH, h//NHASH
+        if v<mins[b]:
+            mins[b] = v
+    for b in range(NHASH): # empty bins borrow from the next full one (densification)
+        if mins[b]==MASK:
+            n = 1
+            while mins[(b+n)%NHASH]==MASK:
+                n += 1
+            mins[b] = (mins[(b+n)%NHASH]+n*0x9e3779b97f4a7c15)&MASK
+    return array.array('Q', mins).tobytes()
+
+def similar(s1, s2):
+    "estimated Jaccard similarity of two signatures - the fraction of equal minimums"
+    a, b = memoryview(s1).cast('Q'), memoryview(s2).cast('Q')
+    return sum(x==y for x, y in zip(a, b))/NHASH
+
+retitlewords = re.compile(r'\w+')
+
+def titlewords(x):
+    "the words in all the titles of tune x - see ABClib.sorttitle()"
+    return frozenset(w for t in x.sorttitles(all=True, fix=True) for w in retitlewords.findall(t))
+
+class Tunes:
+    """
+    signatures and title words of the tunes in ABC files
+    self.tunes is a list of (file, Xid, title, key, signature, title words, title keys)
+    """
+    def __init__(self, fns, cache=True):
+        self.tunes, self.signed = [], 0
+        for fn in fns:
+            self.add(fn, cache)
+        return
+
+    def add(self, fn, cache=True):
+        "add the tunes in ABC file fn"
+        ss = ABClib.Songsets(fn, midi=False, cache=cache)
+        cfn = ABClib.cachename(fn, '.dups')
+        old = (ABClib.loadcache(cfn, (DUPS, SHINGLE, NHASH)) if cache else None) or {}
+        sigs = {}
+        for x in ss.abcs():
+            h = hashlib.sha256(x.linesstr().encode()).digest()[:16]
+            if h in old:
+                sig = old[h]
+            elif h in sigs:
+                sig = sigs[h]
+            else:
+                sig = signature(shingles(*x.notes()[::2]))
+                self.signed += 1
+            sigs[h] = sig
+            self.tunes.append((fn, x.xid, x.title(fix=True) or '', x.key() or '', sig, titlewords(x), frozenset(x.sorttitles(all=True, fix=True, drop=True))))
+        if cache and sigs.keys()!=old.keys(): # only the tunes in the file now
+            ABClib.savecache(cfn, (DUPS, SHINGLE, NHASH), sigs)
+        return
+
+    def candidates(self):
+        "pairs of tunes (numbers) that share an LSH band or a title"
+        pairs = set()
+        buckets = collections.defaultdict(list)
+        for n, t in enumerate(self.tunes):
+            sig = t[4]
+            if sig:
+                for b in range(0, NHASH*8, ROWS*8):
+                    buckets[b, sig[b:b+ROWS*8]].append(n)
+            for st in t[6]:
+                buckets[st].append(n)
+        skipped = 0
+        for ns in buckets.values():
+            if len(ns)>MAXBUCKET:
+                skipped += 1
+                continue
+            for i, a in enumerate(ns):
+                for b in ns[i+1:]:
+                    pairs.add((a, b))
+        if skipped:
+            print(skipped, "bands or titles shared by more than", MAXBUCKET, "tunes were ignored")
+        return pairs
+
+    def score(self, a, b):
+        "(note similarity, title similarity) of tunes a and b"
+        ta, tb = self.tunes[a], self.tunes[b]
+        notes = similar(ta[4], tb[4]) if ta[4] and tb[4] else 0
+        words = len(ta[5]&tb[5])/len(ta[5]|tb[5]) if ta[5] or tb[5] else 0
+        return notes, 1 if ta[6]&tb[6] else words
+
+    def clusters(self, threshold=0.5, titled=0.3):
+        """
+        groups of duplicate tunes - [(tune numbers, [(a, b, notes, titles) ...]) ...] biggest first
+        A pair are duplicates if their note similarity is at least threshold - or titled if they share a title.
+        """
+        up = list(range(len(self.tunes))) # union-find
+        def find(n):
+            while up[n]!=n:
+                up[n] = up[up[n]]
+                n = up[n]
+            return n
+        dups = []
+        for a, b in sorted(self.candidates()):
+            notes, titles = self.score(a, b)
+            if notes>=threshold or (titles==1 and notes>=titled):
+                dups.append((a, b, notes, titles))
+                up[find(a)] = find(b)
+        groups = collections.defaultdict(list)
+        for d in dups:
+            groups[find(d[0])].append(d)
+        cs = [(sorted(set(n for d in ds for n in d[:2])), ds) for ds in groups.values()]
+        cs.sort(key=lambda c:(-len(c[0]), c[0]))
+        return cs
+
+def main():
+    p = argparse.ArgumentParser(description="find duplicate tunes in ABC libraries")
+    p.add_argument('-t', '--threshold', type=float, default=0.5, help="note similarity (0 to 1) for duplicates (default 0.5)")
+    p.add_argument('--titled', type=float, default=0.3, help="note similarity for duplicates with the same title (default 0.3)")
+    p.add_argument('--nocache', action='store_true', help="do not use (or write) the signature caches")
+    p.add_argument('files', nargs='+', help="ABC libraries")
+    args = p.parse_args(sys.argv[1:])
+
+    t = time.perf_counter()
+    ts = Tunes(args.files, cache=not args.nocache)
+    print(len(ts.tunes), "tunes,", ts.signed, "signed in {0:.1f}s".format(time.perf_counter()-t))
+    t = time.perf_counter()
+    cs = ts.clusters(args.threshold, args.titled)
+    print(len(cs), "groups of duplicates found in {0:.1f}s".format(time.perf_counter()-t))
+    many = len(args.files)>1
+    for ns, ds in cs:
+        print()
+        for n in ns:
+            fn, xid, title, key = ts.tunes[n][:4]
+            print("  {0}X:{1:6} {2} ({3})".format(fn+" " if many else "", xid, title, key))
+        for a, b, notes, titles in ds:
+            print("    X:{0} ~ X:{1} - notes {2:.0f}%, titles {3:.0f}%".format(ts.tunes[a][1], ts.tunes[b][1], 100*notes, 100*titles))
+    return
+
+if __name__=="__main__":
+    main()
@@ -1,49 +1,57 @@
 """
 Program to extract Booklets from ABC library files
 
-Sets to extract come from a MS Excel file
-Each row has a comma separated list of tune X IDs in column A
+Sets to extract come from a MS Excel file (or a CSV file, e.g. from getlist.py)
+Each row has a '-' separated list of tune X IDs in column A
+
+    python3 abcextract.py SrcABC xlsx DstABC
+uses the active sheet of the workbook. In batch mode (-b)
+    python3 abcextract.py -b SrcABC lists.xlsx more.csv ...
+each sheet of each workbook (and each CSV file) makes its own ABC file - named
+lists-<sheet>.abc and more.abc - all from one read of the library.
 
 Bob Buckley 3/12/2025
 """
 
+import os
+import re
+import csv
 import sys
+import argparse
+import concurrent.futures
+
 import ABClib
 import openpyxl
 
-def main():
-    # read an ABC file 
-    # file names should come from arguments 
-    # fn = "PBBtunes20251103.abc"
-    # wb = "abcextract-test.xlsx"
-    # fd = "XXX.abc"
-
-    if len(sys.argv)!=4:
-        print("usage: prog SrcABC xlsx DstABC")
-        exit(1)
-    
-    pn, fn, wb, fd = sys.argv
-    assert fn.endswith(".abc")
-    assert wb.endswith(".xlsx")
-    assert fd.endswith(".abc")
-
-    ss=ABClib.Songsets(fn)
-    td = ABClib.abcdict(ss.abcs()) # read tune dictionary
-    hdr = ss.hdr
-    ss = None
-    
-    dwsa = openpyxl.load_workbook(wb).active
-    # active workbook in Excel file - may need more here
-    cols = list(dwsa.iter_cols(1, dwsa.max_column))
-    setlist = [ str(c.value).split('-') for c in cols[0] ]
-
-    if setlist[0][0].startswith('set'): # A1 starts with 'set' if it's a header line
+def sheetsets(rows):
+    "the set list (lists of Xids) from the column A values"
+    setlist = [str(v).split('-') for v in rows if v is not None]
+    if setlist and setlist[0][0].startswith('set'): # A1 starts with 'set' if it's a header line
         setlist.pop(0)
-    # print("setlist=", setlist)
+    return setlist
 
+def readlists(fn, allsheets=True):
+    """
+    the set lists in an xlsx or CSV file - [(name, setlist), ...]
+    name is the sheet name (None for CSV). Workbooks are read in read-only (streaming) mode.
+    allsheets=False only reads the active sheet.
+    """
+    if fn.endswith('.csv'):
+        with open(fn, 'rt', newline='') as src:
+            return [(None, sheetsets(r[0] for r in csv.reader(src) if r))]
+    wb = openpyxl.load_workbook(fn, read_only=True)
+    try:
+        return [(ws.title, sheetsets(r[0] for r in ws.iter_rows(min_col=1, max_col=1, values_only=True)))
+                for ws in (wb.worksheets if allsheets else [wb.active])]
+    finally:
+        wb.close()
+
+def extract(xi, hdr, setlist, fd):
+    "write the tunes in setlist from xi (an ABClib.XidIndex) to ABC file fd - returns the missing Xids"
+    missing = []
     # separators - %%newpage before and after a set, %%sep between single tunes
     seps = [ "\n\n%%newpage\n" if any(len(x)>1 for x in xs) else "\n\n%%sep\n" for xs in zip(setlist, setlist[1:]) ]+[""]
-    
+
     with open(fd, "tw") as dst:
         for l in hdr:# write ABC file header
             dst.write(l)
@@ -52,16 +60,73 @@ def main():
             # print('-'.join(vs))
             for tasc in vs:
                 dst.write("\nX: "+tasc+"\n")
-                if tasc in td:
-                    for l in td[tasc]:
+                if tasc in xi:
+                    for l in xi.song(tasc).lines:
                         dst.write(l)
                         dst.write('\n')
                 else:
-                    print('tune', tasc, 'not in ABC file.')
+                    missing.append(tasc)
             if s:
                 dst.write(s)
         dst.write('\n\n')
+    return missing
+
+def main():
+    # read an ABC file
+    # fn = "PBBtunes20251103.abc"
+    # wb = "abcextract-test.xlsx"
+    # fd = "XXX.abc"
+    p = argparse.ArgumentParser(description="extract tune books from an ABC library - Xids from xlsx or CSV files")
+    p.add_argument('--nocache', action='store_true', help="don't use (or write) the Xid index cache")
+    p.add_argument('-b', '--batch', action='store_true', help="an ABC file for each sheet/CSV file listed")
+    p.add_argument('-d', '--dir', help="output directory for batch mode (default: beside each list)")
+    p.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="number of ABC files written at the same time")
+    p.add_argument('file', help="source ABC library")
+    p.add_argument('lists', nargs='+', help="xlsx DstABC - or (batch mode) xlsx/CSV files")
+    args = p.parse_args(sys.argv[1:])
+
+    fn = args.file
+    assert fn.endswith(".abc")
+    if args.batch:
+        assert all(x.endswith(('.xlsx', '.csv')) for x in args.lists), "lists must be xlsx or CSV files"
+    elif len(args.lists)!=2:
+        p.error("expects SrcABC xlsx DstABC (or -b for batch mode)")
+    else:
+        assert args.lists[0].endswith((".xlsx", ".csv"))
+        assert args.lists[1].endswith(".abc")
+
+    # Xid index of the library - only the tunes that are extracted are read
+    xi = ABClib.XidIndex(fn, cache=not args.nocache)
+    hdr = xi.hdr()
+
+    jobs = [] # (setlist, DstABC)
+    if args.batch:
+        for lfn in args.lists:
+            d, bn = os.path.split(lfn)
+            bn = os.path.splitext(bn)[0]
+            for sheet, setlist in readlists(lfn):
+                name = bn if sheet is None else bn+'-'+re.sub(r'[^\w.-]+', '_', sheet)
+                jobs.append((setlist, os.path.join(args.dir if args.dir else d, name+'.abc')))
+        if args.dir:
+            os.makedirs(args.dir, exist_ok=True)
+    else:
+        jobs.append((readlists(args.lists[0], allsheets=False)[0][1], args.lists[1]))
+    # print("setlist=", setlist)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        fs = [pool.submit(extract, xi, hdr, setlist, fd) for setlist, fd in jobs]
+        missing = {}
+        for (setlist, fd), f in zip(jobs, fs):
+            for x in f.result():
+                missing.setdefault(x, []).append(fd)
+            print("wrote", fd, "-", sum(len(s) for s in setlist), "tunes in", len(setlist), "sets")
+    xi.close()
+
+    if missing:
+        print(len(missing), "Xids not in", fn+":")
+        for x, fds in sorted(missing.items(), key=lambda e:(len(e[0]), e[0])):
+            print("  ", x, "in", ", ".join(sorted(set(fds))))
     return
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Serve an ABC library as a book on a local web server - e.g. to browse the whole library at rehearsals
+
+    python3 abcserve.py [addsvg.py options] [--port 8000] PBBtunes.abc
+then open http://localhost:8000/ in a browser.
+
+The page is an addsvg.py book (the same template and index options) without the tunes - each set's ABC
+is fetched from /set/<xid> (any Xid in the set) when it is scrolled to or an index link goes to it,
+so a big library opens as quickly as a small one. The library is parsed once and kept in memory.
+When the ABC file or template is saved the library is read again (only new and edited tunes are
+parsed - ABClib.Songsets.reload()) and the page is rebuilt (reusing the HTML for unchanged sets and
+indices) - reload the page in the browser to see it.
+
+Responses have an ETag (a hash of the content) so the browser only downloads the page and sets
+that have changed.
+
+@author: Bob Buckley
+"""
+
+import os
+import io
+import sys
+import time
+import hashlib
+import threading
+import contextlib
+import http.server
+import urllib.parse
+
+import ABClib
+import assets
+import addsvg
+import addbooks
+
+class Book:
+    "the page and the ABC for each set - kept up to date with the ABC file and template"
+    def __init__(self, args, interval=0.5):
+        self.args, self.interval = args, interval
+        self.lock = threading.Lock() # addsvg.build() is not thread safe
+        self.ss = ABClib.Songsets(args.file, midi=args.playback, cache=not args.nocache, reuse=True)
+        self.acache = None if args.noassetcache else assets.AssetCache(args.assetcache, offline=args.offline)
+        self.frags, self.stamps, self.checked = {}, {}, 0
+        self.rebuild()
+        return
+
+    def rebuild(self):
+        "build the page and the sets"
+        t = time.perf_counter()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            page = addsvg.build(self.args, ss=self.ss, tmpl=addbooks.gettmpl(self.args), acache=self.acache, prevfrags=self.frags, serve=True)
+        self.frags = addsvg.frags
+        sets, x2set = {}, {}
+        for sset, nset in zip(self.ss.sets, self.ss.sets[1:]+[[]]):
+            sets[sset[0].xid] = self.entry(addsvg.setabc(sset, nset))
+            for s in sset:
+                x2set[s.xid] = sset[0].xid
+        page = self.entry(page)
+        # one attribute so the page and sets are always from the same build - get() reads it without the lock
+        self.built = (page, sets, x2set)
+        self.stamps = dict((fn, addbooks.stamp(fn)) for fn in addbooks.bookfiles(self.args))
+        print(time.strftime("%H:%M:%S"), "built page -", len(sets), "sets,", len(page[1]), "bytes in {0:.2f}s".format(time.perf_counter()-t))
+        return
+
+    def entry(self, text):
+        "(ETag, data) for text"
+        data = text.encode()
+        return '"'+hashlib.sha256(data).hexdigest()[:24]+'"', data
+
+    def refresh(self):
+        "read the ABC file and template again if they have changed (checked at most every interval seconds)"
+        with self.lock:
+            if time.monotonic()-self.checked<self.interval:
+                return
+            self.checked = time.monotonic()
+            changed = [fn for fn, st in self.stamps.items() if addbooks.stamp(fn)!=st]
+            if not changed:
+                return
+            for fn in changed:
+                print(time.strftime("%H:%M:%S"), "changed:", fn)
+            try:
+                if os.path.abspath(self.args.file) in changed:
+                    self.ss.reload()
+                addbooks.tmpls.pop(os.path.abspath(self.args.template), None) # read the template again
+                self.rebuild()
+            except (Exception, SystemExit) as e: # keep serving the last good build - the next save may fix it
+                print("FAILED -", repr(e))
+        return
+
+    def get(self, path):
+        "(ETag, data, content type) for a URL path - or None"
+        self.refresh()
+        page, sets, x2set = self.built
+        if path in ('/', '/index.htm', '/index.html'):
+            return page+("text/html; charset=utf-8",)
+        if path.startswith('/set/'):
+            xid = x2set.get(urllib.parse.unquote(path[5:]))
+            if xid:
+                return sets[xid]+("text/vnd.abc; charset=utf-8",)
+        return None
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    "GET the page or a set - the book is the server's book attribute"
+    def do_GET(self):
+        r = self.server.book.get(self.path.split('?', 1)[0])
+        if r is None:
+            self.send_error(404)
+            return
+        etag, data, ctype = r
+        if etag in [x.strip() for x in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache') # always check the ETag - the library may have changed
+        self.end_headers()
+        self.wfile.write(data)
+        return
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+        return
+
+def main():
+    p = addsvg.argparser()
+    p.description = "serve an ABC library as an addsvg.py book on a local web server"
+    p.add_argument('--port', type=int, default=8000, help="web server port (default 8000)")
+    p.add_argument('--host', default='localhost', help="web server address (default localhost - only this computer)")
+    p.add_argument('--verbose', action='store_true', help="log each request")
+    args = p.parse_args(sys.argv[1:])
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    server.book = Book(args)
+    server.verbose = args.verbose
+    print("serving", args.file, "at http://{0}:{1}/ - Ctrl-C to stop".format(args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    server.server_close()
+    return
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build several HTML books with addsvg.py from one manifest (JSON or TOML)
+
+Each book in the manifest uses addsvg.py's options - named as in "python3 addsvg.py --help"
+(the long option names with - changed to _), with the value addsvg.py would get, e.g.
+{
+  "file": "PBBtunes.abc", "template": "abcsvg.htm",
+  "books": [
+    {"output": "session.htm", "rhythmsetindex": true},
+    {"output": "grid.htm", "grid2": true, "titlesx": "B, R", "contents": false},
+    {"output": "band.htm", "txtmus": true, "xids": ["1", "5", "6", "22"]}
+  ]
+}
+Settings outside "books" apply to every book. "xids" picks a subset of tunes (the sets they are in are kept).
+
+Each ABC library and template is read once. The books are built in parallel (a process pool)
+and share the asset cache.
+
+Watch mode (-w) keeps running with the libraries, templates and assets in memory. It checks the
+ABC files, templates and the local files the templates use (polling) and, a moment after they stop
+changing (so a burst of saves is one rebuild), rebuilds only the books that use the changed files.
+Unchanged tunes are not parsed again (ABClib.Songsets.reload()) and the HTML for unchanged
+sets and indices is reused (like addsvg.py -i). addsvg.py --watch does the same for one book.
+
+@author: Bob Buckley
+"""
+
+import os
+import io
+import sys
+import copy
+import json
+import time
+import argparse
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+import bs4
+
+import ABClib
+import assets
+import addsvg
+
+libs, tmpls = {}, {} # ABC libraries and templates that have been read - shared with (forked) worker processes
+
+def getlib(args, reuse=False):
+    "the ABC library for a book - read once (reuse - ready for Songsets.reload())"
+    k = (os.path.abspath(args.file), args.playback)
+    if k not in libs:
+        libs[k] = ABClib.Songsets(args.file, midi=args.playback, cache=not args.nocache, reuse=reuse)
+    return libs[k]
+
+def gettmpl(args):
+    "the parsed template for a book - read once (addsvg.build() copies it)"
+    k = os.path.abspath(args.template)
+    if k not in tmpls:
+        with open(args.template, mode="rt") as tmplsrc:
+            tmpls[k] = bs4.BeautifulSoup(tmplsrc, 'lxml')
+    return tmpls[k]
+
+def subset(ss, xids):
+    "a copy of Songsets ss with only the tunes in xids"
+    xs = set(str(x) for x in xids)
+    sx = copy.copy(ss)
+    sx.sets = [s for s in ([x for x in st if x.xid in xs] for st in ss.sets) if s]
+    return sx
+
+def bookargs(p, book):
+    "addsvg.py arguments (a Namespace) for a book from the manifest"
+    if 'file' not in book:
+        p.error("book has no ABC 'file': "+str(book))
+    args = p.parse_args([book['file']])
+    for k, v in book.items():
+        if k=='xids':
+            continue
+        if not hasattr(args, k):
+            p.error("unknown setting '"+k+"' in book: "+str(book))
+        setattr(args, k, v)
+    return args
+
+def buildbook(book, args):
+    "build one book - runs in a worker process - returns (output file, addsvg output text, seconds)"
+    t = time.perf_counter()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ss = getlib(args)
+        if 'xids' in book:
+            ss = subset(ss, book['xids'])
+        target = addsvg.build(args, ss=ss, tmpl=gettmpl(args))
+    return target, out.getvalue(), time.perf_counter()-t
+
+def bookfiles(args):
+    "the files a book is made from - {file name: 'lib', 'tmpl' or 'asset'}"
+    fs = {os.path.abspath(args.template):'tmpl'}
+    for t in gettmpl(args).find_all(["img", "link", "script"]):
+        src = t.get("href" if t.name=="link" else "src")
+        if src and os.path.isfile(src):
+            fs[os.path.abspath(src)] = 'asset'
+    fs[os.path.abspath(args.file)] = 'lib'
+    return fs
+
+def stamp(fn):
+    "what changes when a file is saved - None if it is not there (yet)"
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def watch(books, bargs, interval=0.2, settle=0.3):
+    """
+    rebuild books (with addsvg.py arguments bargs) when the files they are made from change - see above
+    interval is the polling time and settle is how long (seconds) files must be unchanged before a rebuild
+    """
+    acache = None if all(ba.noassetcache for ba in bargs) else assets.AssetCache(bargs[0].assetcache, offline=bargs[0].offline)
+    prevfrags = {} # HTML fragments from the previous build of each book
+    def rebuild(todo):
+        for i in todo:
+            book, ba = books[i], bargs[i]
+            t = time.perf_counter()
+            out = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(out):
+                    ss = getlib(ba, reuse=True)
+                    if 'xids' in book:
+                        ss = subset(ss, book['xids'])
+                    target = addsvg.build(ba, ss=ss, tmpl=gettmpl(ba), acache=None if ba.noassetcache else acache, prevfrags=prevfrags.get(i, {}))
+                prevfrags[i] = addsvg.frags
+            except (Exception, SystemExit) as e: # keep watching - the next save may fix it
+                print(out.getvalue())
+                print("FAILED", book.get('output', book['file']), "-", repr(e))
+                continue
+            print(time.strftime("%H:%M:%S"), "built", target, "in {0:.2f}s".format(time.perf_counter()-t))
+        return
+
+    def watched(i):
+        "the files book i is made from - with deleted ones (so it is rebuilt when they are back)"
+        try:
+            fs = bookfiles(bargs[i])
+        except OSError: # the template can't be read
+            return files[i]
+        fs.update((fn, k) for fn, k in files[i].items() if stamps[fn] is None)
+        return fs
+
+    for ba in bargs:
+        getlib(ba, reuse=True) # so reloads only parse new and edited tunes
+    for ss in libs.values():
+        if ss.known is None: # read before watching started
+            ss.reload()
+    files = [bookfiles(ba) for ba in bargs]
+    stamps = dict((fn, stamp(fn)) for fs in files for fn in fs)
+    rebuild(range(len(books)))
+    print("watching", len(stamps), "files for", len(books), "books - Ctrl-C to stop")
+    changed, last = set(), 0
+    try:
+        while True:
+            time.sleep(interval)
+            for fn in stamps:
+                st = stamp(fn)
+                if st!=stamps[fn]:
+                    stamps[fn] = st
+                    changed.add(fn)
+                    last = time.monotonic()
+            if not changed or time.monotonic()-last<settle:
+                continue # wait for the files to settle (editors may save in several steps)
+            t = time.perf_counter()
+            for fn in changed:
+                print(time.strftime("%H:%M:%S"), "deleted:" if stamps[fn] is None else "changed:", fn)
+                for k, ss in list(libs.items()):
+                    if k[0]==fn:
+                        if stamps[fn] is None: # rebuild() reports it - and reads it again when it is back
+                            del libs[k]
+                        else:
+                            ss.reload()
+                if fn in tmpls:
+                    del tmpls[fn]
+            todo = [i for i, fs in enumerate(files) if changed & set(fs)]
+            files = [watched(i) for i in range(len(bargs))] # templates may use different files now
+            for fn in set(f for fs in files for f in fs)-set(stamps):
+                stamps[fn] = stamp(fn)
+            changed = set()
+            rebuild(todo)
+            if len(todo)>1:
+                print("   ", len(todo), "books in {0:.2f}s".format(time.perf_counter()-t))
+    except KeyboardInterrupt:
+        print()
+    return
+
+def main():
+    p = argparse.ArgumentParser(description="build several addsvg.py books from a manifest (JSON or TOML)")
+    p.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of books built at the same time")
+    p.add_argument("-v", "--verbose", action='store_true', help="show addsvg.py output for each book")
+    p.add_argument("-w", "--watch", action='store_true', help="keep running - rebuild books when their files change")
+    p.add_argument('manifest', help="JSON or TOML file listing the books")
+    args = p.parse_args(sys.argv[1:])
+
+    if args.manifest.endswith('.toml'):
+        import tomllib
+        with open(args.manifest, 'rb') as src:
+            manifest = tomllib.load(src)
+    else:
+        with open(args.manifest, 'rt') as src:
+            manifest = json.load(src)
+    defaults = dict((k, v) for k, v in manifest.items() if k!='books')
+    books = [dict(defaults, **b) for b in manifest.get('books', [])]
+    if not books:
+        print("no books in", args.manifest)
+        exit(1)
+
+    ap = addsvg.argparser()
+    bargs = [bookargs(ap, b) for b in books]
+    # read the libraries and templates before starting the workers - forked workers share them
+    t = time.perf_counter()
+    for ba in bargs:
+        getlib(ba, reuse=args.watch)
+        gettmpl(ba)
+    print("read", len(libs), "ABC libraries and", len(tmpls), "templates in {0:.2f}s".format(time.perf_counter()-t))
+    if args.watch:
+        watch(books, bargs)
+        return
+
+    ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(books))), mp_context=ctx) as pool:
+        fs = [pool.submit(buildbook, b, ba) for b, ba in zip(books, bargs)]
+        for book, f in zip(books, fs): # report in manifest order
+            try:
+                target, out, secs = f.result()
+            except (Exception, SystemExit) as e:
+                failed += 1
+                print("FAILED", book.get('output', book['file']), "-", repr(e))
+                continue
+            if args.verbose:
+                print(out)
+            print("built", target, "in {0:.2f}s".format(secs))
+    if failed:
+        exit(1)
+    return
+
+if __name__=="__main__":
+    main()
@@ -28,19 +28,173 @@ to do:
 import os
 import re
 import sys
+import copy
 import argparse
+import collections
+import json
+import time
+import tracemalloc
 import datetime as dt
-import base64
-import urllib.request
+import hashlib
+import html
+import itertools
+import unicodedata
 
 import bs4
 
 import ABClib
+import assets
+import incipits
 
 doc, body0, nblk = None, None, None
 x2page = {}
+frags, oldfrags = {}, {} # HTML text for sets and indices - see addfrag()
+BOOKFRAGS = 3 # version of the fragments (manifest) file - change it when the generated HTML changes
+refrag = re.compile(r'<!--abcfrag ([0-9a-f ]+)-->')
+reid = re.compile(r'\sid="([^"]*)"') # ids in the HTML fragments (qattr() quotes them)
+# images that are used more than once are embedded once - this copies them to the other <img> tags
+sameimgjs = '\ndocument.querySelectorAll("img[data-same]").forEach(function (i) { i.src = document.getElementById(i.getAttribute("data-same")).src })\n'
+
+def esc(s):
+    "escape text for HTML"
+    return html.escape(s, quote=False)
+
+def qattr(s):
+    "quoted HTML attribute value"
+    return '"'+esc(s).replace('"', '&quot;')+'"'
+
+def fraghash(build, args, key=None):
+    "the key for the HTML made by build(*args) in frags - a hash of args, or of key if it is given"
+    return hashlib.sha256(repr((build.__name__, args if key is None else key)).encode()).hexdigest()
+
+def addfrag(build, args, where, before=False, key=None):
+    """
+    add the HTML text made by build(*args) to the document - append it to where, or insert it before where
+    The document gets a placeholder comment and the HTML is kept in frags keyed on a hash of args.
+    See splice() for output. For an incremental build, the HTML is reused from the previous build
+    (oldfrags) when args have not changed.
+    key (if given) is hashed instead of args - something small that changes whenever the HTML would,
+    so args (which may be big, or slow to make) are only used when the HTML is built.
+    where can be a list - the key is added to it and the caller adds one placeholder for them all (see splice()).
+    returns True if the HTML was reused
+    """
+    global frags, oldfrags
+    reused = False
+    h = fraghash(build, args, key)
+    if h not in frags:
+        reused = h in oldfrags
+        frags[h] = oldfrags[h] if reused else build(*args)
+    if isinstance(where, list):
+        where.append(h)
+    elif before:
+        where.insert_before(bs4.Comment('abcfrag '+h))
+    else:
+        where.append(bs4.Comment('abcfrag '+h))
+    return reused
 
-def addindex(iname, items, sort=True, breakat=[], nochords=False):
+def splice(out):
+    "put the HTML fragments into the (text) output - see addfrag() - a placeholder can have several keys"
+    return refrag.sub(lambda m: ''.join(frags[h] for h in m.group(1).split()), out)
+
+class Profile:
+    """
+    --profile: wall time, CPU time, tracemalloc peak, DOM nodes made and bytes written for each phase of a build
+    A phase lasts until the next one starts (or done()).
+    """
+    def __init__(self):
+        self.phases, self.name = [], None
+        tracemalloc.start()
+        return
+
+    def nodes(self):
+        "elements in the document - and in the HTML fragments (see addfrag())"
+        n = len(doc.find_all(True)) if doc else 0
+        return n+sum(f.count('<')-f.count('</')-f.count('<!') for f in frags.values())
+
+    def phase(self, name):
+        "start phase name"
+        self.done()
+        self.name, self.nbytes, self.n0 = name, 0, self.nodes()
+        self.m0 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        return
+
+    def wrote(self, nbytes):
+        "count bytes written in this phase"
+        self.nbytes += nbytes
+        return
+
+    def done(self):
+        "end the current phase"
+        if self.name is None:
+            return
+        wall, cpu = time.perf_counter()-self.wall, time.process_time()-self.cpu
+        peak = tracemalloc.get_traced_memory()[1]-self.m0
+        self.phases.append({'phase':self.name, 'wall':wall, 'cpu':cpu, 'peak_kb':peak//1024,
+                            'nodes':self.nodes()-self.n0, 'bytes':self.nbytes})
+        self.name = None
+        return
+
+    def report(self, jsonfn=None):
+        "print the phases as a table - and write them to a JSON file"
+        self.done()
+        tracemalloc.stop()
+        print("{0:28} {1:>8} {2:>8} {3:>10} {4:>8} {5:>10}".format("phase", "wall s", "cpu s", "peak kB", "nodes", "bytes"))
+        for p in self.phases+[{'phase':'total', 'wall':sum(p['wall'] for p in self.phases), 'cpu':sum(p['cpu'] for p in self.phases),
+                               'peak_kb':max([p['peak_kb'] for p in self.phases]+[0]), 'nodes':sum(p['nodes'] for p in self.phases),
+                               'bytes':sum(p['bytes'] for p in self.phases)}]:
+            print("{phase:28} {wall:8.3f} {cpu:8.3f} {peak_kb:10} {nodes:8} {bytes:10}".format(**p))
+        if jsonfn:
+            with open(jsonfn, 'wt') as dst:
+                json.dump(self.phases, dst, indent=1)
+            print("profile written to", jsonfn)
+        return
+
+class NoProfile:
+    "no --profile - does nothing"
+    def phase(self, name):
+        return
+    def wrote(self, nbytes):
+        return
+    def done(self):
+        return
+
+tfix = re.compile(r'^T:\s*-') # titles starting with a minus sign (omitted from indices)
+
+def setabc(sset, nset):
+    "the ABC for a set (or single tune) - nset is the next set ([] for the last one)"
+    # remove - from T: lines when present (leading minus means omit title from index)
+    # %%MIDI commands in songs screw up abc2svg playback
+    xlines = '\n'.join('X: '+s.xid+"\n"+''.join(tfix.sub('T:', x)+"\n" for x in s.lines if not x.startswith('%%MIDI')) for s in sset)
+    return xlines + ("\n%%sep\n\n" if len(sset)==1 and len(nset)==1 else "\n")
+
+def setfrag(svgid, sp, hdrstr, sset, nset, nop, lazy=False):
+    "setblock() for a set - its ABC (setabc()) is only made when the HTML is not reused (see addfrag())"
+    return setblock(svgid, sp, hdrstr, setabc(sset, nset), nop, lazy)
+
+def setblock(svgid, sp, hdrstr, abcstr, nop, lazy=False, src=None):
+    """
+    HTML for a set (or single tune) - <div id=svgid> with ABC in <script> tags
+    sp is True for sets, hdrstr is the ABC header (first set only) or None.
+    nop adds a non-printing %%sep after the set.
+    lazy uses a script type that abcweb doesn't render - lazyabc.js renders the set when it is needed
+    src is the URL lazyabc.js fetches the ABC from (abcserve.py) - then abcstr is not in the page
+    """
+    scr = '<script type="text/vnd.abc{0}">{{0}}</script>\n'.format('-lazy' if lazy else '') # ABC is not escaped in <script>
+    # sets get sp class, os a separate page in CSS
+    out = ['<div class="abcdiv'+(' sp' if sp else '')+'" id='+qattr(svgid)+(' data-abc='+qattr(src) if src else '')+'>\n  ']
+    if hdrstr:
+        out.append((scr.replace('<script', '<script class="abchdr"') if lazy else scr).format(hdrstr))
+    if not src:
+        out.append(scr.format(abcstr))
+    out.append('</div>\n')
+    # should add non-printing %%seps around sets - sets on separate pages - HTML doesn't show page breaks. 
+    if nop:
+        out.append('<div class="nop">'+scr.format("\n%%sep\n\n")+'  </div>')
+    return ''.join(out)
+
+def addindex(iname, items, sort=True, breakat=[], nochords=False, key=None, skipempty=False):
     """
     insert an index into the document
     iname might be "Dance Index"
@@ -48,10 +202,24 @@ def addindex(iname, items, sort=True, breakat=[], nochords=False):
     xid's are strings that can be interpreted as integers
     this routine sorts the index items when arg. sort is True.
     We should probably send the link ID rather than using the global x2page
+    items can be a function that returns them - it is only called if the index is not reused from the
+    previous build. Then key must change whenever the items or their link IDs would (see addfrag()).
+    skipempty leaves out an index with no items.
     """
     global doc, body0, nblk, x2page
 
     idxname = iname.replace(' ', '').lower()
+    if callable(items):
+        args = (iname, idxname, items, sort, breakat, nochords)
+        fkey = (iname, idxname, key, sort, breakat, nochords)
+        h = fraghash(indexfrag, args, fkey)
+        if skipempty and h not in frags and h not in oldfrags and not items():
+            return
+    else:
+        if skipempty and not items:
+            return
+        xlink = dict((x[2], x2page[x[2]]) for x in items)
+        args, fkey = (iname, idxname, items, sort, breakat, nochords, xlink), None
     if nblk:
         print(" ... adding", iname, "link to Nav Block.")
         bx = doc.new_tag("span")
@@ -61,22 +229,26 @@ def addindex(iname, items, sort=True, breakat=[], nochords=False):
         bx.insert_after("\n")
         bx.insert_before("  ")
     
-    didiv = doc.new_tag("div")
-    didiv["class"] = "section index"
-    didiv.append("\n    ")
-    didiv.append(doc.new_tag("h1"))
-    didiv.append("\n    ")
-    didiv.append(doc.new_tag("div"))
-    didiv.div.append("\n")
-    didiv.div["class"] = ('colidx nochords' if nochords else 'colidx chords')
+    if addfrag(indexfrag if callable(items) else indexdivs, args, body0, before=True, key=fkey):
+        print("       reused", iname, "from the previous build")
+    return
+
+def indexfrag(iname, idxname, items, sort, breakat, nochords):
+    "indexdivs() for an index whose items are made by calling items - see addindex()"
+    items = items()
+    return indexdivs(iname, idxname, items, sort, breakat, nochords, dict((x[2], x2page[x[2]]) for x in items))
+
+def indexdivs(iname, idxname, items, sort, breakat, nochords, xlink):
+    """
+    HTML for an index - see addindex()
+    xlink maps the xid's in items to their link ID
+    """
+    colidx = '<div class="'+('colidx nochords' if nochords else 'colidx chords')+'">\n'
+    out = ['<div class="section index" id='+qattr(idxname)+'>\n    <h1>'+esc(iname)+'</h1>\n    '+colidx]
 
     # xbreakat = [(".".join([y.strip() for y in x.split(".",1)]+[""])) for x in breakat]
     xbreakat = [('' if x[2] is None else x[2], x[3]) for x in map(lambda z: re.match(r'^((\d+)\.?)?\s*(.*)', z), breakat)]
 
-
-    didiv["id"] = idxname
-    didiv.h1.string = iname
-    body0.insert_before(didiv)
     if sort:
         idxs = sorted(items, key=lambda x:(x[0], x[1].lower() if type(x[1]) is str else x[1], int(x[2])))
     else:
@@ -91,76 +263,134 @@ def addindex(iname, items, sort=True, breakat=[], nochords=False):
         #if any((xid==x[0] and dn.startswith(x[1])) for x in xbreakat): # add start of title check later
         if breakat and isBreak(xid, dn, xbreakat):
             print("       break at", (xid, (dn if type(dn) is str else dn[0])))
-            didiv = doc.new_tag("div", attrs={'class': 'section index'})
-            #didiv["class"] = "section index"
-            didiv.append(doc.new_tag("h1"))
-            didiv.h1.string = iname + (" (cont.)")  # index title cont. 
-            didiv.append(doc.new_tag("div", attrs={'class': ('colidx nochords' if nochords else 'colidx chords')}))
-            #didiv.div["class"] = "colidx"
-            didiv.div.append("\n")
-            body0.insert_before(didiv)
-
-        didiv.div.append('\t')
-        # idxitm = doc.new_tag('button', attrs={'class':'title'})
-        idxitm = doc.new_tag('button')
+            out.append('</div></div><div class="section index"><h1>'+esc(iname+" (cont.)")+'</h1>'+colidx) # index title cont.
+
+        if type(dn) is str:
+            dnstr = '<div class="xid">'+esc(xid)+'.</div><div>'+esc(ABClib.fixtitle(dn))+'</div>'
+        else:
+            dnstr = '<div><b>'+esc(dn[0])+"</b><br/>\n"+esc(", ".join(ABClib.fixtitle(t) for t in dn[1:]))+'</div>'
+        idxitm = '<button><a href='+qattr('#'+xlink[xid])+'>'+dnstr+'</a></button>'+esc(ktag) # as in template and its CSS
         if cat!=pcat and cat:
             # new category - add <h2> and div to keep with the next button
-            dx = doc.new_tag('div', attrs={'class':'ncb'}) # class=ncb means no-column-break
-            h2 = doc.new_tag('h2')
-            h2.string = cat
-            dx.append(h2)
-            dx.append('\n')
-            dx.append(idxitm)
-            if ktag: dx.append(ktag)
+            out.append('\t<div class="ncb"><h2>'+esc(cat)+'</h2>\n'+idxitm+'</div>\n') # class=ncb means no-column-break
         else:
-            didiv.div.append(idxitm)
-            if ktag: didiv.div.append(ktag)
-            dx = doc.new_tag('br')
-        didiv.div.append(dx)
-        didiv.div.append('\n')
+            out.append('\t'+idxitm+'<br/>\n')
         pcat = cat
-        a = doc.new_tag("a", href='#'+x2page[xid])
-        if type(dn) is str:
-            xtag = doc.new_tag('div', attrs={'class': 'xid'})
-            xtag.string = xid+'.'
-            a.append(xtag)
-            stag = doc.new_tag('div')
-            stag.string = ABClib.fixtitle(dn)
-            a.append(stag)
-        else:
-            dnstr = '<b>'+dn[0]+"</b><br/>\n"+", ".join(ABClib.fixtitle(t) for t in dn[1:])
-            x = bs4.BeautifulSoup("<div>"+dnstr+"</div>", 'lxml') 
-            a.append(x.body.div)
-        idxitm.append(a) # as in template and its CSS
+    out.append('</div></div>')
 
-    return
+    return ''.join(out)
 
-def getsrc(src, embed, mode="rt"):
-    "get external src contents - filename or URL"
-    # always embed files - HTML may get moved and filenames won't work
-    if os.path.isfile(src): # should use URL
-        with open(src, mode=mode) as imgx:
-            data = imgx.read()
-        return True, data
-    elif embed and any(src.startswith(s) for s in ["http://", "https://"]):
-        # url = urllib.request.urlopen(src)
-        with urllib.request.urlopen(src) as urlsrc:
-            data = urlsrc.read().decode()
-        return True, data
-    return False, None
-       
-def main():
+rgn = dict((g, n) for n, rg in enumerate(ABClib.ABCsong.rgroups) for g in rg) # rhythm -> rhythm group number
+rgname = [', '.join(g) for g in ABClib.ABCsong.rgroups]
+# Paverty singer notation - for indexing
+singer = {'bb':'Bob Buckley', 'gc':'Graham Chalker', 'sd':'Simone Dawson', 
+          'br': 'Bryan Rae', 'rk':'Rick Kenyon', 'bp':'Bill Pitt'
+          }
+
+def indexnames(args):
+    "the indices args asks for - see indexitems()"
+    return set(n for n, w in [('contents', args.contents or args.contentsx), ('titles', args.titles or args.titlesx),
+                              ('byrhythm', args.byrhythm or args.byrhythmx), ('alphasets', args.alphasetindex),
+                              ('rhythmsets', args.rhythmsetindex), ('singers', args.pavindex), ('dances', args.danceindex)] if w)
+
+def indexitems(ss, args):
     """
-    input files x.abc and x.xhtml
-    Add indices and abc2svg/txtmus Javascript ... if required
-    Output to target
+    the items for all the indices args asks for - collected in one pass over the library ss
+    returns a dict of index name -> items (in order) for addindex()
+    Each item gets its sort key as it is collected - lower case titles are cached -
+    so each index takes one sort (or one pass over the rhythm group buckets).
     """
-    global doc, body0, nblk
-    global x2page
-    redigits = re.compile('\d+')
-    def fnpage(s):
-        fs = s.rsplit(' ', 2)
-        return fs[0], ''.join(fs[1:])
+    want = indexnames(args)
+    lows = {}
+    def low(t):
+        "cached lower case title for sorting"
+        if t not in lows:
+            lows[t] = t.lower()
+        return lows[t]
+    idx = dict((n, []) for n in want)
+    rbuckets = [[] for g in rgname] # tunes by rhythm group
+    sbuckets = [[] for g in rgname] # sets by rhythm group
+    for s in ss.sets:
+        if 'contents' in want: # note: contents index shows sets
+            idx['contents'].append(('', [x.title(fix=True)+' ('+x.key()+')' for x in s], s[0].xid, ''))
+        if len(s)>1 and 'alphasets' in want:
+            t0 = s[0].title()
+            idx['alphasets'].append((t0.upper(), (t0[0].upper(), '; '.join("{0} ({1})".format(t.title(fix=True), t.key()) for t in s), s[0].xid)))
+        if len(s)>1 and 'rhythmsets' in want:
+            g = rgn[s[0].rhythmgroup()]
+            sbuckets[g].append((s[0].title(), (rgname[g], '; '.join(t.title(fix=True) for t in s), s[0].xid)))
+        for x in s:
+            if not x.index:
+                continue
+            xid, key = x.xid, x.key()
+            ixid = int(xid) if want & {'titles', 'singers', 'dances'} else 0
+            if 'titles' in want:
+                # index all tune titles, not just the first title (unless dropped - start with minus) - in alphabetic order of titles
+                idx['titles'].extend(((t[0], low(t), ixid), (t[0], t, xid, key)) for t in x.titles(drop=True))
+            if 'byrhythm' in want:
+                g = rgn[x.rhythmgroup()]
+                rbuckets[g].append((x.title(), (rgname[g], x.title(), xid, key)))
+            if 'singers' in want:
+                v = x.vocalist()
+                if v!='-':
+                    v = singer.get(v, v)
+                    idx['singers'].extend(((v, low(xt), ixid), (v, xt, xid, key)) for xt in x.titles() if not xt.startswith('-'))
+            if 'dances' in want:
+                zs = (z.strip() for tl in x.taglines('N') if tl.lower().strip().startswith('set dance:') for z in tl.split(':', 1)[-1].split(';'))
+                idx['dances'].extend((('', low(z), ixid), ('', z, xid)) for z in zs)
+    # sort - the sort keys are the first part of each entry
+    for n in want & {'titles', 'alphasets', 'singers', 'dances'}:
+        idx[n] = [item for k, item in sorted(idx[n], key=lambda e:e[0])]
+    if 'byrhythm' in want:
+        idx['byrhythm'] = [item for b in rbuckets for k, item in sorted(b, key=lambda e:e[0])]
+    if 'rhythmsets' in want:
+        idx['rhythmsets'] = [item for b in sbuckets for k, item in sorted(b, key=lambda e:e[0])]
+    return idx
+
+def searchwords(s):
+    "the words in s for the search index - as words() in searchabc.js"
+    s = ''.join(c for c in unicodedata.normalize('NFKD', s.lower()) if not '\u0300'<=c<='\u036f')
+    return re.findall('[0-9a-z\u00c0-\u1fff\u2070-\uffff]+', s)
+
+def searchindex(ss, x2page, notes=False):
+    """
+    the search index (JSON text) for searchabc.js - see the notes there
+    Tunes are numbered in title order. The words are from the titles (after fixtitle() and sorttitle() -
+    titles starting with '-' are included), N: and W: lines.
+    notes adds the first notes of each tune (see incipits.py) so tunes can be found by how they start.
+    """
+    def delta(a):
+        return [a[0]]+[y-x for x, y in zip(a, a[1:])] if a else a
+    tunes = []
+    for x in (x for s in ss.sets for x in s if x.index):
+        ts = [ABClib.fixtitle(t.lstrip('-').strip()) for t in x.titles()]
+        tunes.append((ABClib.sorttitle(ts[0]) if ts else '', x, [t for t in ts if t] or ['']))
+    tunes.sort(key=lambda e:e[0])
+    posts = {} # word -> [tune*2+1 for title words, tune*2 for other words]
+    for n, (k, x, ts) in enumerate(tunes):
+        tws = set(w for t in ts for w in searchwords(ABClib.sorttitle(t)))
+        for w in tws:
+            posts.setdefault(w, []).append(2*n+1)
+        for w in set(w for l in itertools.chain(x.taglines('N'), x.words()) for w in searchwords(l))-tws:
+            posts.setdefault(w, []).append(2*n)
+    words = sorted(posts)
+    grams = {} # trigram -> word numbers
+    for i, w in enumerate(words):
+        for g in sorted(set(w[j:j+3] for j in range(len(w)-2))):
+            grams.setdefault(g, []).append(i)
+    idx = {'d': [[x.xid, ts, x.key() or '']+([x2page[x.xid]] if x2page[x.xid]!=x.id() else []) for k, x, ts in tunes],
+           'w': words, 'p': [delta(posts[w]) for w in words],
+           'g': dict((g, delta(v)) for g, v in grams.items())}
+    if notes:
+        idx['i'] = [incipits.ivtext(x.notes(incipits.BARS)[0]) for k, x, ts in tunes]
+    return json.dumps(idx, ensure_ascii=False, separators=(',', ':')).replace('<', '\\u003c') # safe in <script>
+
+def searchblock(idxjson, notes=False):
+    "HTML for the search index - see searchindex()"
+    return '<script type="application/json" id="abcsearch"'+(' data-notes=""' if notes else '')+'>'+idxjson+'</script>\n'
+
+def argparser():
+    "command line arguments - also used for the books in a batch (see addbooks.py)"
     p = argparse.ArgumentParser(description="ABC XHTML indexer")
     p.add_argument("-e", '--embed', action='store_false', help="do not embed <link href...> and <script src=...> in a single file - used for quicker testing")
     p.add_argument("-p", "--playback", action="store_false", help="do not include snd-?.js for playback")
@@ -178,18 +408,70 @@ def main():
     p.add_argument("-d", '--danceindex', action='store_true', help="include 'dance index' for set dance tunes")
     p.add_argument("-G", '--grid2', action='store_true', help="use %%grid2 1 to present chord charts, not music")
     p.add_argument('-o', '--output', help="output/target filename")
+    p.add_argument('--nocache', action='store_true', help="do not use (or write) the parsed ABC library cache")
+    p.add_argument('-i', '--incremental', action='store_true', help="reuse the HTML for sets and indices that have not changed since the previous build")
+    p.add_argument("-w", '--watch', action='store_true', help="keep running - rebuild when the ABC file, template or its local files change")
+    p.add_argument('--offline', action='store_true', help="only use the local asset cache for URLs - no downloads")
+    p.add_argument('--assetcache', help="asset cache directory (default "+assets.CACHEDIR+")")
+    p.add_argument('--noassetcache', action='store_true', help="always download URLs - don't use the asset cache")
+    p.add_argument('-j', '--jobs', type=int, default=8, help="number of assets fetched/encoded at the same time (default 8)")
+    p.add_argument('--timing', action='store_true', help="report the time taken for each embedded asset")
+    p.add_argument('--profile', action='store_true', help="report time, memory, DOM nodes and bytes written for each phase of the build")
+    p.add_argument('--profilejson', help="also write the --profile report to this JSON file")
+    p.add_argument('--imgmax', type=int, help="resize embedded images to fit this size (pixels) - needs Pillow")
+    p.add_argument('--imgquality', type=int, help="recompress embedded JPEG images at this quality (e.g. 80) - needs Pillow")
+    p.add_argument('--bundle', help="write embedded files (once, named for their content) to this shared directory instead of embedding them")
+    p.add_argument("-m", '--minify', action='store_true', help="minify embedded Javascript and CSS, and whitespace between tags")
+    p.add_argument("-z", '--precompress', action='append', choices=['gz', 'br'], help="also write a .gz or .br (brotli) copy of the output (repeat for both)")
+    p.add_argument("-S", '--search', action='store_true', help="add a search box (titles, N: notes, W: words and Xids) with a search index made when the book is built")
+    p.add_argument("-I", '--incipits', action='store_true', help="the search box (-S) also finds tunes by their first notes - type | then ABC notes")
+    p.add_argument("-L", '--lazy', action='store_true', help="render sets as they are scrolled to (for big books) - abcweb/tmweb not used, so no playback")
     xgrp = p.add_mutually_exclusive_group()
     xgrp.add_argument("-1", "--abc2svg", action='store_true', help="include abc2svg javascipt")
     xgrp.add_argument("-2", "--txtmus",  action='store_true', help="include txtmus javascipt")
     # p.add_argument("-s", '--style', type=argparse, help="CSS file to be included")
     p.add_argument("-f", "--template", default="abcsvg.htm", help="HTML template (default is abcsvg.htm)")
     p.add_argument('file', help="name of ABC file")
-    args = p.parse_args(sys.argv[1:])
+    return p
+
+def main():
+    args = argparser().parse_args(sys.argv[1:])
+    if args.watch:
+        import addbooks # the same watch loop as for several books
+        addbooks.watch([{'file':args.file}], [args])
+        return
+    build(args)
+    return
+
+def build(args, ss=None, tmpl=None, acache=None, prevfrags=None, serve=False):
+    """
+    input files x.abc and x.xhtml
+    Add indices and abc2svg/txtmus Javascript ... if required
+    Output to target
+    ss (the ABC library) and tmpl (the parsed template - it is copied) can be passed in if they have already been read
+    as can acache (an assets.AssetCache) and prevfrags (frags from the previous build of this book - like -i)
+    serve builds the page for abcserve.py - a lazy book that fetches each set's ABC from set/<xid>.
+    It returns the HTML (nothing is written).
+    """
+    global doc, body0, nblk
+    global x2page, frags, oldfrags
+    redigits = re.compile('\d+')
+    def fnpage(s):
+        fs = s.rsplit(' ', 2)
+        return fs[0], ''.join(fs[1:])
+    frags, oldfrags = {}, {}
+    doc = None
+    prof = Profile() if args.profile or args.profilejson else NoProfile()
+    lazy = args.lazy or serve
     
     # read an HTML file as the basis for the output
+    prof.phase("template")
     print("Template from", args.template)
-    with open(args.template, mode="rt") as tmplsrc:
-        doc = bs4.BeautifulSoup(tmplsrc, 'lxml')
+    if tmpl:
+        doc = copy.copy(tmpl)
+    else:
+        with open(args.template, mode="rt") as tmplsrc:
+            doc = bs4.BeautifulSoup(tmplsrc, 'lxml')
            
     # changes to body
     body = doc.body
@@ -223,10 +505,24 @@ def main():
         print("****** date not set ***********")
     nblk = body.find(id="nblist")
 
+    d, fn = os.path.split(args.file)
+    bn, ext = os.path.splitext(fn)
+    target = args.output if args.output else os.path.join(d, bn+".htm")
+    if prevfrags is not None:
+        oldfrags = prevfrags
+    elif args.incremental:
+        # HTML fragments from the previous build of target
+        fragsfn = ABClib.cachename(target, '.frags')
+        oldfrags = ABClib.loadcache(fragsfn, BOOKFRAGS) or {}
+
     print("reading", fnsrc)
+    prof.phase("ABC library")
 
     # read the ABC file into a Songsets class
-    ss = ABClib.Songsets(fnsrc, midi=args.playback)
+    if ss is None:
+        ss = ABClib.Songsets(fnsrc, midi=args.playback, cache=not args.nocache)
+        if ss.cached:
+            print("parsed ABC from cache")
     # print(len(ss.sets), "sets found.")
     abcs = tuple(ss.abcs()) # songlist rather than list of sets
     print(len(abcs), "songs/tunes in", len(ss.sets), "sets.")
@@ -241,109 +537,89 @@ def main():
     body0 = abcsect.previous_element
    
     # add the ABC data into the HTML
-    tfix = re.compile(r'^T:\s*-') # titles starting with a minus sign (omitted from indices)
-    hdr = ss.hdr
+    prof.phase("sets")
+    hdr = ss.hdr[:] # a copy - it may be changed below
+    nreused, sethashes = 0, [] # one placeholder for all the sets - quicker than a comment each in the document
     for sset, nset in zip(ss.sets, ss.sets[1:]+[[]]):
         svgid = sset[0].id()
 
-        newtag = doc.new_tag("div", id=svgid)
-        newtag.append("\n  ")
-        newtag["class"] = "abcdiv"+(' sp' if len(sset)>1 else '') # sets get sp class, os a separate page in CSS
+        hdrstr = None
         if hdr:
             if args.grid2:
                 hdr.append("%%grid2 1")
             # we leave %%MIDI lines in the header/parameters block - they should be OK there - just keep it simple
             hdrstr = "".join(t+"\n" for t in hdr+[''])
-            hdrdiv = doc.new_tag("script", type="text/vnd.abc")
-            hdrdiv.string = hdrstr
-            newtag.append(hdrdiv)
-            newtag.append("\n")
             hdr = None
-        scr = doc.new_tag("script", type="text/vnd.abc")
-        # remove - from T: lines when present (leading minus means omit title from index)
-        # %%MIDI commands in songs screw up abc2svg playback
-        xlines = '\n'.join('X: '+s.xid+"\n"+''.join(tfix.sub('T:', x)+"\n" for x in s.lines if not x.startswith('%%MIDI')) for s in sset)
-        scr.string =  xlines + ("\n%%sep\n\n" if len(sset)==1 and len(nset)==1 else "\n")
-        newtag.append(scr)
-        newtag.append("\n")
-        abcsect.append(newtag)
-        abcsect.append("\n")
-        # should add non-printing %%seps around sets - sets on separate pages - HTML doesn't show page breaks. 
-        if len(nset)>0 and not(len(sset)==1 and len(nset)==1):
-            newtag = doc.new_tag("div")
-            newtag["class"] = "nop"
-            newtag.append(doc.new_tag("script", type="text/vnd.abc"))
-            newtag.script.string = "\n%%sep\n\n"
-            newtag.append("\n  ")
-            abcsect.append(newtag)
+        nop = len(nset)>0 and not(len(sset)==1 and len(nset)==1)
+        if serve: # the page does not change when only the tunes' ABC does
+            nreused += addfrag(setblock, (svgid, len(sset)>1, hdrstr, None, nop, True, 'set/'+sset[0].xid), sethashes)
+        else:
+            nreused += addfrag(setfrag, (svgid, len(sset)>1, hdrstr, sset, nset, nop, args.lazy), sethashes,
+                               key=(svgid, len(sset)>1, hdrstr, [x.digest() for x in sset], len(nset)==1, nop, args.lazy))
+    if sethashes:
+        abcsect.append(bs4.Comment('abcfrag '+' '.join(sethashes)))
+    if args.incremental or prevfrags is not None:
+        print("reused", nreused, "of", len(ss.sets), "sets from the previous build")
                                    
     # add tune index
     # omit titles with '-' at start
+    prof.phase("index entries")
+    idx = {}
+    def items(name):
+        "a function for the items of an index - indexitems() is only called if an index is not reused"
+        def get():
+            if not idx:
+                idx.update(indexitems(ss, args))
+            return idx[name]
+        return get
+    want = indexnames(args)
+    # what the indices are made from - the sets and what is indexed in each tune (see ABClib.ABCsong.idxdigest())
+    ikey = hashlib.sha256(repr([[x.idxdigest() for x in s] for s in ss.sets]).encode()).hexdigest()
    
-    if args.contents or args.contentsx:
+    if 'contents' in want:
         # add Table of Contents - only the first title of a tune - in the order they appear
-        # cx = [('', x.title(fix=True), x.xid, x.key()) for x in abcs]
-        # note: context index shows sets
-        cx = [('', [x.title(fix=True)+' ('+x.key()+')' for x in s], s[0].xid, '') for s in ss.sets]
         # just does Xids for now - add title prefixes later
         breakat = [x.strip() for x in args.contentsx.split(',')] if args.contentsx else []
         # print("Contents breakat =", breakat)
-        addindex("Contents", cx, sort=False, breakat=breakat, nochords=True)
+        prof.phase("index: Contents")
+        addindex("Contents", items('contents'), key=ikey, sort=False, breakat=breakat, nochords=True)
 
-    if args.titles or args.titlesx:
-        # index all tune titles, not just the first title (unless dropped - start with minus) - in alphabetic order of titles
-        tuneindex = [(t[0], t, x.xid, x.key()) for x in abcs if x.index for t in x.titles(drop=True)]
+    if 'titles' in want:
         breakat = [x.strip() for x in args.titlesx.split(',')] if args.titlesx else []
-        addindex("Titles", tuneindex, breakat=breakat) 
+        prof.phase("index: Titles")
+        addindex("Titles", items('titles'), key=ikey, sort=False, breakat=breakat) 
 
-    rgn = dict((g, n) for n, rg in enumerate(ABClib.ABCsong.rgroups) for g in rg)
-    rgname = [', '.join(g) for g in ABClib.ABCsong.rgroups]
-    if args.byrhythm or args.byrhythmx: 
-        sx = [s for s in abcs if x.index]
-        sx.sort(key=lambda s:(rgn[s.rhythmgroup()], s.title()))
+    if 'byrhythm' in want: 
         # should fix the breakat below to use command line argument
         breakat = [x.strip() for x in args.byrhythmx.split(',')] if args.byrhythmx else []
-        addindex("By rhythm", [(rgname[rgn[x.rhythmgroup()]], x.title(), x.xid, x.key()) for x in sx], sort=False, breakat=breakat)
+        prof.phase("index: By rhythm")
+        addindex("By rhythm", items('byrhythm'), key=ikey, sort=False, breakat=breakat)
          
-    if args.alphasetindex:
-        # create a sorted list of sets
-        sx = [s for s in ss.sets if len(s)>1]
-        sx.sort(key=lambda s:s[0].title().upper())
-
-        def setfmt1(ts):
-            return ts[0].title()[0].upper(), '; '.join("{0} ({1})".format(t.title(fix=True), t.key()) for t in ts), ts[0].xid
-        addindex("Sets (alphabetic)", [setfmt1(x) for x in sx], sort=False, nochords=True)
+    if 'alphasets' in want:
+        prof.phase("index: Sets (alphabetic)")
+        addindex("Sets (alphabetic)", items('alphasets'), key=ikey, sort=False, nochords=True)
     
-    if args.rhythmsetindex:
-        # dts = tuple(x[0] for x in ABClib2.ABCsong.rgroups)
-        sx = [s for s in ss.sets if len(s)>1]
-        sx.sort(key=lambda s:(rgn[s[0].rhythmgroup()], s[0].title()))
-        def setfmt2(ts):
-            return rgname[rgn[ts[0].rhythmgroup()]], '; '.join(t.title(fix=True) for t in ts), ts[0].xid
-        addindex("Sets by rhythm", [setfmt2(xs) for xs in sx], sort=False, nochords=True)
-
-
-     # Paverty singer notation - for indexing
-    if args.pavindex:
-        singer = {'bb':'Bob Buckley', 'gc':'Graham Chalker', 'sd':'Simone Dawson', 
-                  'br': 'Bryan Rae', 'rk':'Rick Kenyon', 'bp':'Bill Pitt'
-                  }
-        sditems = [(x.vocalist(), xt, x.xid, x.key()) for x in abcs if x.index for xt in x.titles() if not xt.startswith('-')]
-        sditems = [(singer[s] if s in singer else s, t, x, k) for s,t,x,k in sditems if s!='-']
-        addindex("Singers", sditems, sort=True)
-        
-
-    # add set dance index
-    if args.danceindex:
-        sditems = [('', z.strip(), x.xid) for x in abcs if x.index for tl in x.taglines('N') if tl.lower().strip().startswith('set dance:') for z in tl.split(':', 1)[-1].split(';')]
-        if sditems:
-            addindex("Dances", sditems)
+    if 'rhythmsets' in want:
+        prof.phase("index: Sets by rhythm")
+        addindex("Sets by rhythm", items('rhythmsets'), key=ikey, sort=False, nochords=True)
+
+    if 'singers' in want:
+        prof.phase("index: Singers")
+        addindex("Singers", items('singers'), key=ikey, sort=False)
+
+    # add set dance index - if there are set dances
+    if 'dances' in want:
+        prof.phase("index: Dances")
+        addindex("Dances", items('dances'), key=ikey, sort=False, skipempty=True)
     
-    # finishing up
-    d, fn = os.path.split(args.file)
-    bn, ext = os.path.splitext(fn)
-    target = args.output if args.output else os.path.join(d, bn+".htm")
+    search = args.search or args.incipits
+    if search:
+        prof.phase("search index")
+        print(" ... adding search index"+(" with first notes" if args.incipits else ""))
+        addfrag(searchblock, (searchindex(ss, x2page, args.incipits), args.incipits), body)
 
+    # finishing up
+    prof.phase("scripts")
     # check for ABC scripts ...
     ssrcs = [z for z in (x.rsplit('/',1)[-1] for x in doc.head.find_all("script") if x.has_attr("src")) if any(z.startswith(fns) for fns in ['abc2svg', 'abcweb', 'tmcore', 'tmweb'])]
     if ssrcs:
@@ -372,13 +648,35 @@ def main():
     if args.grid2:
         jslist.append("/home/bobb/mywin/OneDrive/Documents/GitHub/render-ABC/gchordfix.js")
     
+    if lazy:
+        # lazyabc.js renders the sets with the abc2svg/txtmus core - abcweb/tmweb would render everything at once
+        def isweb(src):
+            return any(src.rsplit('/', 1)[-1].startswith(fn) for fn in ['abcweb', 'tmweb', 'snd-'])
+        jslist = [js for js in jslist if not isweb(js)]
+        for rtag in [x for x in doc.find_all("script") if x.has_attr("src") and isweb(x["src"])]:
+            print("lazy - removing", rtag)
+            rtag.extract()
+
     for js in jslist:
         print(" ... adding <script src={0}>".format(js))
         body.append(doc.new_tag("script", src=js, defer=""))
         body.append("\n")
 
+    for jsfn in (['lazyabc.js'] if lazy else [])+(['searchabc.js'] if search else []):
+        print(" ... adding", jsfn)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), jsfn), mode="rt") as src:
+            ownjs = doc.new_tag("script")
+            ownjs.append("\n"+src.read())
+        body.append(ownjs) # always inline - it is small and runs after the (deferred) abc2svg scripts have loaded
+        body.append("\n")
+
     print("look for embedding files *********************************************")
+    prof.phase("embed")
+    if acache is None and not args.noassetcache:
+        acache = assets.AssetCache(args.assetcache, offline=args.offline)
     # embed image files before output is done.
+    # find what to embed, fetch and encode everything in parallel, then change the document in document order
+    imgs = []
     for img in (x for x in doc.body.find_all("img") if 'src' in x.attrs):
         if "src" in img.attrs:
             src = img.attrs['src']
@@ -387,27 +685,16 @@ def main():
             if len(srcx)!=2 or itype not in ["jpg", "png"]:
                 print("  ", img, "not embedded!")
                 continue
-            em, imgdata = getsrc(src, args.embed, mode='rb')
-            if em:
-                print("  Embed img", src)
-                img.attrs['src'] = "data:image/"+itype+";base64,"+base64.standard_b64encode(imgdata).decode()
+            imgs.append((img, (assets.embedimg, src, itype, args.embed, acache, args.imgmax, args.imgquality)))
 
     # there should be an option to embed <script src="filename" ...> and <link rel="stylesheet" href="filename"> files as well ...
 
     def embedlink(t):
         # note: t["rel"] returns a list
         return t.has_attr("href") and "stylesheet" in t.attrs.get("rel",[])
-    txt = None
-    for rtag in (x for x in doc.head.find_all("link") if embedlink(x)):
-        em, txt = getsrc(rtag["href"], args.embed)
-        if em:
-            print("  Embed link ", rtag["href"])
-            rtag.name = "style"
-            rtag.append("\n"+txt)
-            rtag["type"] = "text/css"
-            del rtag["rel"]
-            del rtag["href"]
+    links = [(rtag, (assets.embedcss, rtag["href"], args.embed, acache)) for rtag in doc.head.find_all("link") if embedlink(rtag)]
 
+    scripts = []
     for rtag in (x for x in doc.find_all("script") if x.has_attr("src")):
         efn = rtag["src"].rsplit('/', 1)[-1]
         if efn.startswith('snd-'):
@@ -415,25 +702,90 @@ def main():
                 print("embedding snd-?.js does not work (without a local /js directory for all the abc2svg stuff.)")
             if args.playback and args.embed:
                 print("removing", rtag)
-                rtag.remove()
+                rtag.extract()
                 continue
-        # embed external content and remove src attribute
-        em, txt = getsrc(rtag["src"], args.embed)
-        if em:
-            if any(efn.startswith(fn) for fn in ["abc2svg", "tmcore"]):
-                txt = txt.replace("MIDI:{},", "") # fix loading of MIDI - doesn't work when embedded
-                print("fixing MIDI call when emdedding ...")
-            print("  Embed script ", rtag["src"])
-            txt = "\n"+txt.replace("'</script>", "'<'+'/script>") # break the string up so HTML loading works
-            rtag.append(txt)
-            del rtag["src"]
-    del txt
-
+        scripts.append((rtag, (assets.embedjs, rtag["src"], args.embed, acache)))
+
+    jobs = imgs+links+scripts
+    if args.bundle:
+        # write each asset once to the shared bundle directory (named for its content) - the book refers to it
+        jobs = [(rtag, (assets.bundle, job[1], args.bundle, acache, args.minify, args.embed)+((args.imgmax, args.imgquality) if job[0] is assets.embedimg else ()))
+                for rtag, job in jobs]
+        results = assets.fetchall([j for t, j in jobs], args.jobs)
+        for (rtag, job), ((bfn, fixmidi), t) in zip(jobs, results):
+            if bfn:
+                ref = assets.bundleref(bfn, target)
+                print("  Bundle", job[1], "as", ref)
+                rtag["href" if rtag.name=="link" else "src"] = ref
+    else:
+        results = assets.fetchall([j for t, j in jobs], args.jobs)
+        # an image used more than once is embedded once - the others copy it (sameimgjs)
+        nsame = collections.Counter(data for data, t in results[:len(imgs)] if data)
+        first, ids = {}, None
+        def newid():
+            "an id for an image that is used again - not one the template or HTML fragments already have"
+            nonlocal ids
+            if ids is None:
+                ids = set(t['id'] for t in doc.find_all(id=True))
+                ids.update(i for f in frags.values() for i in reid.findall(f))
+            n = len(first)+1
+            while 'abcimg'+str(n) in ids:
+                n += 1
+            ids.add('abcimg'+str(n))
+            return 'abcimg'+str(n)
+        for (img, job), (data, t) in zip(imgs, results):
+            if data and data in first:
+                print("  Same img", job[1], "- embedded once")
+                img['data-same'] = first[data]
+                del img['src']
+            elif data:
+                print("  Embed img", job[1])
+                img.attrs['src'] = data
+                if nsame[data]>1:
+                    if not img.has_attr('id'):
+                        img['id'] = newid()
+                    first[data] = img['id']
+        if first:
+            sx = doc.new_tag("script")
+            sx.append(sameimgjs)
+            body.append(sx)
+            body.append("\n")
+        for (rtag, job), (txt, t) in zip(links, results[len(imgs):]):
+            if txt:
+                print("  Embed link ", rtag["href"])
+                rtag.name = "style"
+                rtag.append(txt)
+                rtag["type"] = "text/css"
+                del rtag["rel"]
+                del rtag["href"]
+        for (rtag, job), ((txt, fixmidi), t) in zip(scripts, results[len(imgs)+len(links):]):
+            # embed external content and remove src attribute
+            if txt:
+                if fixmidi:
+                    print("fixing MIDI call when emdedding ...")
+                print("  Embed script ", rtag["src"])
+                rtag.append(txt)
+                del rtag["src"]
+    if args.timing:
+        assets.report([j[1] for t, j in jobs], results)
+    if acache:
+        print(acache.stats())
+
+    if serve:
+        prof.done()
+        return splice(str(doc))
     print("Output sent to", target)
-    with open(target, "w") as dst:
-        print(doc, file=dst)    # doc is BeautifulSoup so that does all the work here.
+    prof.phase("write")
+    # doc is BeautifulSoup (with placeholders for the sets and indices)
+    assets.writebook(target, splice(str(doc)), minify=args.minify, precompress=args.precompress or [])
+    prof.wrote(sum(os.path.getsize(fn) for fn in [target]+[target+'.'+z for z in args.precompress or []] if os.path.isfile(fn)))
+    if args.incremental and prevfrags is None:
+        ABClib.savecache(fragsfn, BOOKFRAGS, frags)
+    prof.done()
+    if args.profile or args.profilejson:
+        prof.report(args.profilejson)
     print("Done.")
-    return
+    return target
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local cache for the assets (abc2svg/txtmus Javascript, CSS, images) that are
+embedded in HTML books by addsvg.py and rawsvg.py
+
+Downloads are kept in a content-addressed store:
+  objects/<sha256> holds the data
+  urls.json maps each URL to the sha256 of its data
+so repeated builds don't need the network. In offline mode, URLs are only read from the cache.
+
+The cache can be seeded from local copies, e.g.
+    python3 assets.py seed http://moinejf.free.fr/js/ ~/js/abc2svg-1.js ~/js/abcweb-1.js
+
+@author: Bob Buckley
+"""
+
+import io
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import base64
+import hashlib
+import itertools
+import argparse
+import threading
+import contextlib
+import urllib.request
+import concurrent.futures
+try:
+    import fcntl # not on Windows - then only threads are kept apart (see AssetCache.urlslock())
+except ImportError:
+    fcntl = None
+
+# default cache directory - ABCASSETS environment variable can change it
+CACHEDIR = os.environ.get('ABCASSETS', os.path.join(os.path.expanduser('~'), '.cache', 'render-ABC', 'assets'))
+
+def isurl(src):
+    "src is a http(s) URL"
+    return any(src.startswith(s) for s in ["http://", "https://"])
+
+def tmpname(fn):
+    "a temporary file name for writing fn - unique to this process and thread (books may be built in parallel)"
+    return fn+'.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+
+class AssetCache:
+    """
+    content-addressed cache of downloaded assets - see the module docstring
+    hits, downloads and missed (offline and not cached) count requests for URLs
+    """
+    def __init__(self, cdir=None, offline=False):
+        self.cdir = cdir if cdir else CACHEDIR
+        self.offline = offline
+        self.hits = self.downloads = self.missed = 0
+        self.lock = threading.Lock() # assets may be fetched in parallel
+        self.urls = self.loadurls()
+        self.mem = {} # url -> data already read - a cache that is kept (e.g. in watch mode) doesn't reread files
+        return
+
+    def loadurls(self):
+        "read urls.json"
+        try:
+            with open(os.path.join(self.cdir, 'urls.json'), 'rt') as src:
+                return json.load(src)
+        except (OSError, ValueError): # no cache yet (or a broken one)
+            return {}
+
+    def objpath(self, h):
+        return os.path.join(self.cdir, 'objects', h)
+
+    def cached(self, url):
+        "data for url from the cache - or None"
+        if url in self.mem:
+            return self.mem[url]
+        h = self.urls.get(url)
+        if not h:
+            return None
+        try:
+            with open(self.objpath(h), 'rb') as src:
+                data = src.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest()!=h: # ignore damaged objects
+            return None
+        self.mem[url] = data
+        return data
+
+    def put(self, url, data):
+        "add data for url to the cache"
+        h = hashlib.sha256(data).hexdigest()
+        ofn = self.objpath(h)
+        if not os.path.isfile(ofn):
+            os.makedirs(os.path.dirname(ofn), exist_ok=True)
+            tmp = tmpname(ofn)
+            with open(tmp, 'wb') as dst:
+                dst.write(data)
+            os.replace(tmp, ofn)
+        with self.urlslock():
+            self.urls = dict(self.loadurls(), **self.urls) # other processes (e.g. addbooks.py) may share the cache
+            self.urls[url] = h
+            self.mem[url] = data
+            self.saveurls()
+        return h
+
+    @contextlib.contextmanager
+    def urlslock(self):
+        "hold while reading, changing and writing urls.json - other threads and processes wait"
+        with self.lock:
+            if not fcntl:
+                yield
+                return
+            os.makedirs(self.cdir, exist_ok=True)
+            with open(os.path.join(self.cdir, 'urls.lock'), 'ab') as lf:
+                fcntl.flock(lf, fcntl.LOCK_EX) # released when lf is closed
+                yield
+        return
+
+    def saveurls(self):
+        "write urls.json - see urlslock()"
+        ufn = os.path.join(self.cdir, 'urls.json')
+        os.makedirs(self.cdir, exist_ok=True)
+        tmp = tmpname(ufn)
+        with open(tmp, 'wt') as dst:
+            json.dump(self.urls, dst, indent=1, sort_keys=True)
+        os.replace(tmp, ufn)
+        return
+
+    def get(self, url):
+        "data (bytes) for url - from the cache if possible, otherwise download it (unless offline)"
+        data = self.cached(url)
+        if data is not None:
+            with self.lock:
+                self.hits += 1
+            return data
+        if self.offline:
+            print("  offline - not in asset cache:", url)
+            with self.lock:
+                self.missed += 1
+            return None
+        with urllib.request.urlopen(url) as urlsrc:
+            data = urlsrc.read()
+        self.put(url, data)
+        with self.lock:
+            self.downloads += 1
+        return data
+
+    def derived(self, key):
+        "data made from an asset (e.g. a resized image) - see putderived() - or None"
+        try:
+            with open(os.path.join(self.cdir, 'derived', key), 'rb') as src:
+                return src.read()
+        except OSError:
+            return None
+
+    def putderived(self, key, data):
+        "keep data made from an asset - key should include a hash of the source data and the settings used"
+        fn = os.path.join(self.cdir, 'derived', key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp = tmpname(fn)
+        with open(tmp, 'wb') as dst:
+            dst.write(data)
+        os.replace(tmp, fn)
+        return
+
+    def seed(self, url, fn):
+        "put a local copy (file fn) of url in the cache"
+        with open(fn, 'rb') as src:
+            return self.put(url, src.read())
+
+    def stats(self):
+        return "asset cache: {0} hits, {1} downloads, {2} missed".format(self.hits, self.downloads, self.missed)
+
+def getsrc(src, embed, mode="rt", cache=None):
+    """
+    get external src contents - filename or URL
+    returns (True, data) or (False, None) if it can't (or shouldn't) be embedded
+    URLs are read through cache (an AssetCache) when there is one.
+    """
+    # always embed files - HTML may get moved and filenames won't work
+    if os.path.isfile(src): # should use URL
+        with open(src, mode=mode) as imgx:
+            data = imgx.read()
+        return True, data
+    elif embed and isurl(src):
+        if cache:
+            data = cache.get(src)
+            if data is None:
+                return False, None
+        else:
+            with urllib.request.urlopen(src) as urlsrc:
+                data = urlsrc.read()
+        return True, (data if 'b' in mode else data.decode())
+    return False, None
+
+# Fetching and encoding assets for embedding - these can run in parallel, see fetchall()
+
+IMGOPT = 2 # version of optimg() - change it when its output changes (it is part of the cache key)
+nopillow = [] # Pillow (PIL) is optional - warn once if it is needed but missing
+
+def optimg(data, itype, maxsize=None, quality=None, cache=None):
+    """
+    shrink image data: downscale to fit maxsize (pixels, the longest side) and recompress
+    (JPEG at quality, PNG optimised). Needs Pillow - without it the image is unchanged.
+    returns (data, itype) - the original if the result is not smaller
+    Results are kept in cache (an AssetCache) keyed on the source data's sha256 and the settings.
+    """
+    key = hashlib.sha256(data).hexdigest()+'-{0}-{1}-{2}.{3}'.format(IMGOPT, maxsize, quality, itype)
+    cached = cache.derived(key) if cache else None
+    if cached is not None:
+        return (cached, itype) if len(cached)<len(data) else (data, itype)
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        if not nopillow:
+            nopillow.append(True)
+            print("  Pillow is not installed - images are not resized or recompressed")
+        return data, itype
+    try:
+        im = ImageOps.exif_transpose(Image.open(io.BytesIO(data))) # the EXIF orientation is not kept - apply it
+        if maxsize and max(im.size)>maxsize:
+            im.thumbnail((maxsize, maxsize), Image.LANCZOS)
+        out = io.BytesIO()
+        if itype=='png':
+            im.save(out, 'PNG', optimize=True)
+        else:
+            im.convert('RGB').save(out, 'JPEG', quality=quality if quality else 85, optimize=True, progressive=True)
+    except (OSError, Image.DecompressionBombError) as e: # not an image Pillow can read - use it as it is
+        print("  image not resized or recompressed -", e)
+        return data, itype
+    odata = out.getvalue()
+    if cache:
+        cache.putderived(key, odata)
+    return (odata, itype) if len(odata)<len(data) else (data, itype)
+
+def embedimg(src, itype, embed, cache=None, maxsize=None, quality=None):
+    """
+    image file/URL src as a data: URL - or None
+    maxsize or quality shrink the image first - see optimg()
+    """
+    em, imgdata = getsrc(src, embed, mode='rb', cache=cache)
+    if em and (maxsize or quality):
+        imgdata, itype = optimg(imgdata, itype, maxsize, quality, cache)
+    return "data:image/"+itype+";base64,"+base64.standard_b64encode(imgdata).decode() if em else None
+
+def embedcss(src, embed, cache=None):
+    "stylesheet src as text for a <style> tag - or None"
+    em, txt = getsrc(src, embed, cache=cache)
+    return "\n"+txt if em else None
+
+def embedjs(src, embed, cache=None):
+    """
+    Javascript src as text for a <script> tag - or None
+    returns (text, fixmidi) - fixmidi is True when the abc2svg/txtmus MIDI call was removed
+    """
+    em, txt = getsrc(src, embed, cache=cache)
+    if not em:
+        return None, False
+    efn = src.rsplit('/', 1)[-1]
+    fixmidi = any(efn.startswith(fn) for fn in ["abc2svg", "tmcore"])
+    if fixmidi:
+        txt = txt.replace("MIDI:{},", "") # fix loading of MIDI - doesn't work when embedded
+    return "\n"+txt.replace("'</script>", "'<'+'/script>"), fixmidi # break the string up so HTML loading works
+
+def bundle(src, bdir, cache=None, minify=False, embed=True, maxsize=None, quality=None):
+    """
+    put a copy of file/URL src in the bundle directory bdir - an alternative to embedding it
+    The copy is named for its content (name-<sha256 prefix>.ext) so books can share it (and browser caches)
+    and it is only written if it is not already there. Javascript gets the same MIDI fix as embedjs().
+    minify uses minjs()/mincss() for .js/.css files. maxsize or quality shrink .jpg/.png images - see optimg().
+    URLs are only copied if embed is True (as for embedding - see getsrc()).
+    returns (bundle file name, fixmidi) - (None, False) if src can't (or shouldn't) be read
+    """
+    em, data = getsrc(src, embed, mode='rb', cache=cache)
+    if not em:
+        return None, False
+    efn = src.rsplit('/', 1)[-1]
+    stem, ext = os.path.splitext(efn)
+    fixmidi = ext=='.js' and any(efn.startswith(fn) for fn in ["abc2svg", "tmcore"])
+    if fixmidi:
+        data = data.replace(b"MIDI:{},", b"")
+    if minify and ext in ('.js', '.css'):
+        data = (minjs if ext=='.js' else mincss)(data.decode()).encode()
+    if (maxsize or quality) and ext.lower() in ('.jpg', '.png'):
+        data, itype = optimg(data, ext[1:].lower(), maxsize, quality, cache)
+    bfn = os.path.join(bdir, stem+'-'+hashlib.sha256(data).hexdigest()[:16]+ext)
+    if not os.path.isfile(bfn):
+        os.makedirs(bdir, exist_ok=True)
+        tmp = tmpname(bfn)
+        with open(tmp, 'wb') as dst:
+            dst.write(data)
+        os.replace(tmp, bfn)
+    return bfn, fixmidi
+
+def bundleref(bfn, target):
+    "the (relative) URL for bundle file bfn in HTML file target"
+    return os.path.relpath(bfn, os.path.dirname(os.path.abspath(target))).replace(os.sep, '/')
+
+def fetchall(jobs, workers=8):
+    """
+    run jobs - (function, args...) tuples - in a bounded thread pool
+    returns a list of (result, seconds) in the same order as jobs, so the results can be
+    applied to the document in document order.
+    """
+    def timed(job):
+        t = time.perf_counter()
+        r = job[0](*job[1:])
+        return r, time.perf_counter()-t
+    if not jobs:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(timed, jobs))
+
+def report(names, results):
+    "print the time taken and size of each asset - results from fetchall()"
+    print("asset timing:")
+    for name, (r, t) in zip(names, results):
+        r = r[0] if type(r) is tuple else r
+        print("  {0:7.3f}s {1:>9} {2}".format(t, len(r) if r else '-', name))
+    return
+
+# Size reduction for books - see writebook()
+
+rejsws = re.compile(r'\s+')
+rejsstr = re.compile(r"""(?s)"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'""") # strings (template literals - see jstemplate())
+rejsre = re.compile(r'/(?![*/])(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[a-z]*')
+rejstok = re.compile(r"""[\w$.\\]+|[^\s\w$.\\"'`/]+|/""")
+rejshead = re.compile(r'\s*(?://[^\n]*\n\s*)*') # comments at the start (licence) are kept
+jsregexafter = set('(,=:[!&|?{};+-*%<>~^') # a / after these starts a regular expression (not division)
+jskeywords = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case', 'do', 'else', 'yield', 'await'}
+minpunct = set('{}()[];,=:<>?&|*%^~') # spaces next to these can go
+
+def jstemplate(txt, pos):
+    "end of the template literal that starts at txt[pos] - ${...} may have strings and template literals"
+    i, n = pos+1, len(txt)
+    while i<n:
+        c = txt[i]
+        if c=='\\':
+            i += 2
+        elif c=='`':
+            return i+1
+        elif txt.startswith('${', i):
+            i, depth = i+2, 1
+            while i<n and depth:
+                c = txt[i]
+                if c=='`':
+                    i = jstemplate(txt, i)
+                elif c in '"\'':
+                    m = rejsstr.match(txt, i)
+                    i = m.end() if m else i+1
+                else:
+                    depth += 1 if c=='{' else -1 if c=='}' else 0
+                    i += 1
+        else:
+            i += 1
+    return n
+
+def minjs(txt):
+    """
+    minify Javascript - safely: only comments and whitespace are removed
+    Line breaks are kept (one for each group of lines) so automatic semicolon insertion still works.
+    Strings, template literals and regular expressions are not changed.
+    """
+    m = rejshead.match(txt)
+    out, pos, n = [m.group().strip()+'\n' if m.group().strip() else ''], m.end(), len(txt)
+    last, pend = '', '' # last token (not whitespace or comment), pending whitespace
+    while pos<n:
+        c = txt[pos]
+        if c.isspace():
+            ws = rejsws.match(txt, pos).group()
+            pend = '\n' if '\n' in ws or pend=='\n' else ' '
+            pos += len(ws)
+            continue
+        if c=='/' and txt.startswith('//', pos):
+            end = txt.find('\n', pos)
+            pos = n if end<0 else end
+            continue
+        if c=='/' and txt.startswith('/*', pos):
+            end = txt.find('*/', pos+2)
+            end = n if end<0 else end+2
+            pend = '\n' if '\n' in txt[pos:end] or pend=='\n' else ' '
+            pos = end
+            continue
+        if c=='`':
+            tok = txt[pos:jstemplate(txt, pos)]
+        else:
+            if c in '"\'':
+                m = rejsstr.match(txt, pos)
+            elif c=='/' and (not last or last in jskeywords or (last[-1] in jsregexafter and not last.endswith(('++', '--')))):
+                m = rejsre.match(txt, pos)
+            else:
+                m = rejstok.match(txt, pos)
+            tok = m.group() if m else c
+        if pend and len(out)>1:
+            if pend=='\n':
+                out.append('\n')
+            elif not (last[-1] in minpunct or tok[0] in minpunct):
+                out.append(' ')
+        pend = ''
+        out.append(tok)
+        last = tok
+        pos += len(tok)
+    return ''.join(out)+'\n'
+
+recsstok = re.compile(r"""(?s)"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|/\*.*?\*/|\s+|[^"'/\s]+|.""")
+
+def mincss(txt):
+    "minify CSS - comments and whitespace are removed (strings are not changed)"
+    out, pend = [], False
+    for tok in recsstok.findall(txt):
+        if tok.startswith('/*') or tok.isspace():
+            pend = True
+            continue
+        if pend and out and not (out[-1][-1] in '{};,>' or tok[0] in '{};,>'):
+            out.append(' ')
+        pend = False
+        if tok.startswith('}') and out and out[-1].endswith(';'):
+            out[-1] = out[-1][:-1]
+        out.append(tok)
+    return '\n'+''.join(out)+'\n'
+
+reraw = re.compile(r'(?is)(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2\s*>)')
+reimgdata = re.compile(r'data:image/[^"\')\s]+')
+
+def jstype(tag):
+    "the opening <script> tag is for Javascript"
+    m = re.search(r'\btype\s*=\s*["\']?([^"\'\s>]+)', tag, flags=re.I)
+    return not m or m.group(1).lower() in ('text/javascript', 'application/javascript', 'module')
+
+def minhtml(text):
+    """
+    minify an HTML book: embedded Javascript (minjs) and CSS (mincss), and whitespace between tags
+    ABC (and other non-Javascript <script>s), <pre> and <textarea> are not changed.
+    """
+    out, pos = [], 0
+    for m in reraw.finditer(text):
+        out.append(re.sub(r'[ \t]{2,}', ' ', re.sub(r'\s*\n\s*', '\n', text[pos:m.start()])))
+        body = m.group(3)
+        if m.group(2).lower()=='script' and body.strip() and jstype(m.group(1)):
+            body = minjs(body)
+        elif m.group(2).lower()=='style':
+            body = mincss(body)
+        out.append(m.group(1)+body+m.group(4))
+        pos = m.end()
+    out.append(re.sub(r'[ \t]{2,}', ' ', re.sub(r'\s*\n\s*', '\n', text[pos:])))
+    return ''.join(out)
+
+budgetcats = ['abc', 'js', 'css', 'images', 'html']
+
+def budget(text):
+    "bytes in each category of an HTML book - see budgetcats"
+    sizes = dict.fromkeys(budgetcats, 0)
+    def count(seg, cat):
+        img = sum(len(x) for x in reimgdata.findall(seg)) # data: URLs are ASCII
+        sizes['images'] += img
+        sizes[cat] += len(seg.encode())-img
+        return
+    pos = 0
+    for m in reraw.finditer(text):
+        count(text[pos:m.start(3)], 'html')
+        tag = m.group(2).lower()
+        count(m.group(3), 'css' if tag=='style' else ('js' if jstype(m.group(1)) else 'abc') if tag=='script' else 'html')
+        pos = m.end(3)
+    count(text[pos:], 'html')
+    return sizes
+
+def writebook(target, text, minify=False, precompress=()):
+    """
+    write an HTML book (text) to target (as print() would)
+    minify - see minhtml(). precompress - 'gz' and/or 'br' - also writes target.gz and/or target.br
+    (for web servers that send precompressed files). A byte budget is printed if either is used.
+    """
+    before = budget(text) if minify or precompress else None
+    if minify:
+        text = minhtml(text)
+    with open(target, "w") as dst:
+        print(text, file=dst)
+    if before is None:
+        return
+    after = budget(text)
+    print("size budget (bytes):")
+    print("  {0:8} {1:>10} {2:>10}".format("", "before", "after" if minify else ""))
+    for cat in budgetcats+['total']:
+        b, a = (sum(before.values()), sum(after.values())) if cat=='total' else (before[cat], after[cat])
+        print("  {0:8} {1:>10} {2:>10}".format(cat, b, a if minify else ""))
+    data = (text+"\n").encode()
+    for z in precompress:
+        if z=='gz':
+            zdata = gzip.compress(data, 9, mtime=0)
+        elif z=='br':
+            try:
+                import brotli
+            except ImportError:
+                print("  brotli is not installed - no", target+".br")
+                continue
+            zdata = brotli.compress(data)
+        with open(target+'.'+z+'.tmp', 'wb') as dst:
+            dst.write(zdata)
+        os.replace(target+'.'+z+'.tmp', target+'.'+z)
+        print("  {0:8} {1:>10} {2:>10} {3}".format(z, "", len(zdata), target+'.'+z))
+    return
+
+def writestream(target, parts, precompress=()):
+    """
+    write an HTML book (an iterable of text parts) to target (as print() would) - the book is never all in memory
+    precompress - as for writebook() - the compressed copies are written at the same time
+    returns the number of bytes in target
+    """
+    zs = []
+    for z in precompress:
+        if z=='gz':
+            zs.append((z, gzip.GzipFile(target+'.gz.tmp', 'wb', 9, mtime=0)))
+        elif z=='br':
+            try:
+                import brotli
+            except ImportError:
+                print("  brotli is not installed - no", target+".br")
+                continue
+            zs.append((z, BrotliFile(brotli.Compressor(), target+'.br.tmp')))
+    n = 0
+    with open(target, "w") as dst:
+        for part in itertools.chain(parts, ["\n"]):
+            dst.write(part)
+            data = part.encode()
+            n += len(data)
+            for z, zdst in zs:
+                zdst.write(data)
+    for z, zdst in zs:
+        zdst.close()
+        os.replace(target+'.'+z+'.tmp', target+'.'+z)
+        print("  {0:8} {1:>10} {2:>10} {3}".format(z, n, os.path.getsize(target+'.'+z), target+'.'+z))
+    return n
+
+class BrotliFile:
+    "a file-like writer for a brotli.Compressor (like gzip.GzipFile) - see writestream()"
+    def __init__(self, compressor, fn):
+        self.c, self.dst = compressor, open(fn, 'wb')
+        return
+
+    def write(self, data):
+        self.dst.write(self.c.process(data))
+        return
+
+    def close(self):
+        self.dst.write(self.c.finish())
+        self.dst.close()
+        return
+
+def main():
+    p = argparse.ArgumentParser(description="manage the local asset cache used when embedding in HTML books")
+    p.add_argument('-c', '--cache', help="cache directory (default "+CACHEDIR+")")
+    sp = p.add_subparsers(dest='cmd', required=True)
+    sx = sp.add_parser('seed', help="add local copies of files - the URL for each is base+filename")
+    sx.add_argument('base', help="base URL e.g. http://moinejf.free.fr/js/")
+    sx.add_argument('files', nargs='+', help="local files")
+    sp.add_parser('list', help="list cached URLs")
+    sx = sp.add_parser('drop', help="remove URLs from the cache - they are downloaded again when next used")
+    sx.add_argument('urls', nargs='+')
+    args = p.parse_args(sys.argv[1:])
+
+    ac = AssetCache(args.cache)
+    if args.cmd=='seed':
+        base = args.base if args.base.endswith('/') else args.base+'/'
+        for fn in args.files:
+            url = base+os.path.basename(fn)
+            print(url, ac.seed(url, fn))
+    elif args.cmd=='list':
+        for url, h in sorted(ac.urls.items()):
+            print(url, h)
+    elif args.cmd=='drop':
+        with ac.urlslock():
+            ac.urls = ac.loadurls()
+            for url in args.urls:
+                if ac.urls.pop(url, None):
+                    print("dropped", url)
+            ac.saveurls()
+    return
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the render-ABC tools - how they scale with the size of the ABC library
+
+    python3 benchmark.py run [-n 100 1000 10000 50000] [-o results.json]
+    python3 benchmark.py run -t ../render-ABC-old -o old.json
+    python3 benchmark.py gen 5000 lib.abc
+    python3 benchmark.py compare old.json new.json
+
+Synthetic (but realistic) ABC libraries are made by genlib(): sets and single tunes
+separated by %%newpage/%%sep, %%begintext blocks, several T: lines, a mix of R:/M:/K:,
+%p: v (vocalist) lines, N: set dance: notes, %%MIDI lines and placeholder X: lines.
+They are kept in the work directory (-d) so later runs use the same libraries.
+
+Each step runs in its own process (so the peak memory - maxrss - is for that step) and
+only the step is timed (not starting Python and importing modules).
+Steps: parse (Songsets, no cache), parse_cached, parse_lazy (Songsets(lazy=True) and the first title
+of each tune - e.g. a tune list), index_<name> for each addsvg index
+(collecting the entries and making the HTML), html (a whole addsvg.py build), embed
+(fetching/encoding the template's assets), rawsvg, abcextract (40 tunes) and getlist.
+
+-t/--tree runs the steps with the modules in another checkout (e.g. an older version), so runs can
+be compared. The tools are run through their command lines (main()) with the options that version
+has (see clihelp()). A step that needs something an older version does not have is "n/a".
+
+@author: Bob Buckley
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import inspect
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import datetime as dt
+
+try:
+    import resource # not on Windows
+except ImportError:
+    resource = None
+
+SIZES = [100, 1000, 10000, 50000]
+STEPS = ['parse', 'parse_cached', 'parse_lazy', 'index_contents', 'index_titles', 'index_byrhythm', 'index_alphasets',
+         'index_rhythmsets', 'index_singers', 'index_dances', 'html', 'embed', 'rawsvg', 'abcextract', 'getlist']
+
+# bits for making tunes
+words = """the a lady of green fields road morning dawn river old man's john fair maid cup tea whiskey hills
+far away march reel jig lament mountain bonnie lass kitty humours castle bridge mill boys girls
+sailor wind rose highland wedding harvest home miller's daughter cuckoo blackbird fiddler""".split()
+rhythms = [('reel', '4/4'), ('reel', 'C'), ('jig', '6/8'), ('double jig', '6/8'), ('single jig', '6/8'), ('polka', '2/4'),
+           ('hornpipe', '4/4'), ('schottische', '4/4'), ('barndance', 'C'), ('march', '2/4'), ('slip jig', '9/8'),
+           ('slide', '12/8'), ('waltz', '3/4'), ('varsovienna', '3/4'), ('minuet', '3/4'), ('maggot', '3/2'),
+           ('reel 32 bars', '4/4'), (None, '6/8'), (None, 'C|'), (None, '2/2'), (None, '3/4')] # ABCsong.rgroups
+keys = ['G', 'D', 'A', 'Amin', 'Edor', 'Ador', 'Cmaj', 'F', 'Bm', 'Emin clef=treble', 'D major', 'Gmix']
+notes = "CDEFGABcdefgab"
+singers = ['bb', 'gc', 'sd', 'br', 'rk', 'bp', 'xx']
+
+def title(rnd):
+    t = ' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 4))).title()
+    return t+', The' if rnd.random()<0.1 else t
+
+def bar(rnd, m):
+    "one bar of notes for metre m"
+    n = {'6/8':6, '9/8':9, '12/8':12, '3/4':6, '2/4':4, '3/2':12}.get(m, 8)
+    return ''.join(rnd.choice(notes)+('2' if rnd.random()<0.1 else '') for _ in range(n))
+
+def genlib(n, seed=1):
+    "lines of a synthetic ABC library with n tunes"
+    rnd = random.Random(seed)
+    yield "%abc-2.1"
+    yield "%%pagewidth 21cm"
+    yield "%%titlefont Times 20"
+    yield "%%MIDI program 1"
+    yield ""
+    x = 1
+    while x<=n:
+        k = rnd.choice([1, 1, 1, 2, 3, 3, 4])
+        for i in range(min(k, n-x+1)):
+            r, m = rnd.choice(rhythms)
+            yield "X: {0}".format(x)
+            for t in range(rnd.choice([1, 1, 1, 2, 2, 3])):
+                yield "T: "+('-' if t and rnd.random()<0.2 else '')+title(rnd)
+            if r:
+                yield "R: "+r
+            yield "M: "+m
+            yield "L: 1/8"
+            if rnd.random()<0.05:
+                yield "N: set dance: {0}; {1}".format(title(rnd), title(rnd))
+            if rnd.random()<0.05: # a song
+                yield "%p: v "+rnd.choice(singers)
+            if rnd.random()<0.02:
+                yield "%%index 0"
+            if rnd.random()<0.1:
+                yield "%%MIDI program "+str(rnd.randint(1, 80))
+            yield "K: "+rnd.choice(keys)
+            for b in range(rnd.choice([2, 4, 4, 8])):
+                yield "|:"+'|'.join(bar(rnd, m) for _ in range(4))+":|"
+            if rnd.random()<0.03:
+                yield "%%begintext"
+                yield "Notes on "+title(rnd)
+                yield ""
+                yield "  (collected from "+title(rnd)+")"
+                yield "%%endtext"
+            if rnd.random()<0.05:
+                yield "W: "+title(rnd)
+                yield "W: "+title(rnd)
+            yield ""
+            x += 1
+            if rnd.random()<0.02: # placeholder for a new tune
+                yield "X: {0}".format(x)
+                yield ""
+                x += 1
+        yield "%%newpage" if k>1 else "%%sep"
+        yield ""
+    return
+
+def libfile(wdir, n, seed=1):
+    "the synthetic library with n tunes - made if it is not there"
+    fn = os.path.join(wdir, "bench{0}-{1}.abc".format(n, seed))
+    if not os.path.isfile(fn):
+        with open(fn+'.tmp', 'wt') as dst:
+            for l in genlib(n, seed):
+                dst.write(l+'\n')
+        os.replace(fn+'.tmp', fn)
+    return fn
+
+def template(wdir):
+    "HTML template (with local stylesheet, image and script to embed) for the benchmarks"
+    fn = os.path.join(wdir, "benchtmpl.htm")
+    rnd = random.Random(2)
+    with open(os.path.join(wdir, "bench.css"), 'wt') as dst:
+        dst.write(''.join("div.c{0} {{ margin: {0}px; /* rule {0} */ }}\n".format(i) for i in range(2000)))
+    with open(os.path.join(wdir, "bench.js"), 'wt') as dst: # about the size of abc2svg-1.js
+        dst.write(''.join("// function {0}\nfunction f{0}(a, b) {{\n    return a + b * {0}; // sum\n}}\n".format(i) for i in range(6000)))
+    with open(os.path.join(wdir, "bench.png"), 'wb') as dst:
+        dst.write(bytes(rnd.getrandbits(8) for _ in range(200000))) # not a real image - it is only embedded
+    with open(fn, 'wt') as dst:
+        dst.write("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8"/>
+<title>Benchmark book</title>
+<link rel="stylesheet" href="bench.css"/>
+</head>
+<body>
+<p id="abcdate"></p>
+<div id="nblist">
+</div>
+<img src="bench.png"/>
+<div id="abcsect">
+</div>
+<script src="bench.js"></script>
+</body>
+</html>
+""")
+    return fn
+
+def takes(f, arg):
+    "True if function f has an argument called arg"
+    return arg in inspect.signature(f).parameters
+
+def clihelp(mod):
+    "the --help text of a tool's command line - '' if it has none (older versions check sys.argv themselves)"
+    out = io.StringIO()
+    sys.argv = [mod.__name__+'.py', '--help']
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+            mod.main()
+    except (SystemExit, Exception):
+        pass
+    return out.getvalue()
+
+def step(name, fn, wdir):
+    "run one benchmark step (in this process) - returns the time taken, or None if this version can't do it"
+    import ABClib
+    import addsvg
+    out = io.StringIO()
+    cwd = os.getcwd()
+    os.chdir(wdir) # the template's files are relative to it
+    try:
+        with contextlib.redirect_stdout(out):
+            cache = takes(ABClib.Songsets, 'cache')
+            if name=='parse':
+                t = time.perf_counter()
+                ABClib.Songsets(fn, **({'cache':False} if cache else {}))
+            elif name=='parse_cached':
+                if not cache:
+                    return None
+                ABClib.Songsets(fn) # make sure the cache is there
+                t = time.perf_counter()
+                ABClib.Songsets(fn)
+            elif name=='parse_lazy':
+                if not takes(ABClib.Songsets, 'lazy'):
+                    return None
+                t = time.perf_counter()
+                ss = ABClib.Songsets(fn, lazy=True)
+                [(x.xid, x.title()) for x in ss.abcs()]
+            elif name.startswith('index_'):
+                if not hasattr(addsvg, 'indexitems'):
+                    return None
+                idx = name[6:]
+                ss = ABClib.Songsets(fn)
+                args = addsvg.argparser().parse_args(['-c', '-t', '-b', fn])
+                setattr(args, {'alphasets':'alphasetindex', 'rhythmsets':'rhythmsetindex', 'singers':'pavindex', 'dances':'danceindex'}.get(idx, idx), True)
+                x2page = dict((x.xid, s[0].id()) for s in ss.sets for x in s)
+                t = time.perf_counter()
+                items = addsvg.indexitems(ss, args)[idx]
+                addsvg.indexdivs(idx, idx, items, False, [], False, dict((x[2], x2page[x[2]]) for x in items))
+            elif name=='embed':
+                try:
+                    import assets
+                except ImportError:
+                    return None
+                template(wdir)
+                t = time.perf_counter()
+                assets.fetchall([(assets.embedimg, 'bench.png', 'png', True), (assets.embedcss, 'bench.css', True), (assets.embedjs, 'bench.js', True)])
+            elif name in ('html', 'rawsvg', 'abcextract', 'getlist'):
+                mod = addsvg if name=='html' else __import__(name)
+                opts = clihelp(mod)
+                if name=='html':
+                    ABClib.Songsets(fn) # the library cache (if this version has one) is there - as in use
+                    argv = ['-e', '-r', '-a', '-P', '-d', '-f', template(wdir), '-o', os.path.join(wdir, 'bench.htm')]
+                    argv += (['--noassetcache'] if '--noassetcache' in opts else [])+[fn]
+                elif name=='rawsvg':
+                    argv = ['-e', '-o', os.path.join(wdir, 'benchraw.htm'), fn]
+                elif name=='abcextract':
+                    xids = [x.xid for x in ABClib.Songsets(fn).abcs()]
+                    xids = random.Random(3).sample(xids, min(40, len(xids)))
+                    if 'CSV' in opts: # CSV lists are quicker to read than xlsx
+                        lfn = os.path.join(wdir, 'bench.csv')
+                        with open(lfn, 'wt') as dst:
+                            dst.write("set\n"+''.join(x+'\n' for x in xids))
+                    else:
+                        try:
+                            import openpyxl
+                        except ImportError:
+                            return None
+                        lfn = os.path.join(wdir, 'bench.xlsx')
+                        wb = openpyxl.Workbook()
+                        for r, x in enumerate(["set"]+xids, 1):
+                            wb.active.cell(r, 1, x)
+                        wb.save(lfn)
+                    if hasattr(ABClib, 'XidIndex'):
+                        ABClib.XidIndex(fn).close() # make sure the index is there
+                    argv = [fn, lfn, os.path.join(wdir, 'benchext.abc')]
+                else:
+                    argv = (['-f'] if '--force' in opts else [])+[fn, os.path.join(wdir, 'benchlist.csv')]
+                sys.argv = [name+'.py']+argv
+                t = time.perf_counter()
+                mod.main()
+            else:
+                raise ValueError("unknown step "+name)
+            t = time.perf_counter()-t
+    finally:
+        os.chdir(cwd)
+    return t
+
+def maxrss():
+    "peak memory (kB) of this process - or None"
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss//1024 if sys.platform=='darwin' else rss # bytes on macOS
+
+def run(args):
+    wdir = args.dir if args.dir else os.path.join(tempfile.gettempdir(), 'render-ABC-bench')
+    os.makedirs(wdir, exist_ok=True)
+    tree = os.path.abspath(args.tree if args.tree else os.path.dirname(os.path.abspath(__file__)))
+    steps = args.steps if args.steps else STEPS
+    results = []
+    for n in args.sizes:
+        fn = libfile(wdir, n)
+        print("{0} tunes: {1} ({2} bytes)".format(n, fn, os.path.getsize(fn)))
+        for s in steps:
+            cp = subprocess.run([sys.executable, os.path.abspath(__file__), 'step', s, fn, wdir, tree], capture_output=True, text=True)
+            if cp.returncode:
+                print("  {0:16} FAILED".format(s))
+                print(cp.stderr)
+                continue
+            r = json.loads(cp.stdout.strip().splitlines()[-1])
+            results.append(dict(tunes=n, step=s, **r))
+            if r['secs'] is None:
+                print("  {0:16} {1:>9}".format(s, "n/a"))
+            else:
+                print("  {0:16} {1:8.3f}s {2:>9} kB".format(s, r['secs'], r['maxrss_kb'] if r['maxrss_kb'] else '-'))
+    try:
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, cwd=tree).stdout.strip()
+    except OSError:
+        version = ''
+    out = {'version':version, 'tree':tree, 'date':dt.datetime.now().isoformat(timespec='seconds'),
+           'python':platform.python_version(), 'platform':platform.platform(), 'results':results}
+    if args.output:
+        with open(args.output, 'wt') as dst:
+            json.dump(out, dst, indent=1)
+        print("results in", args.output)
+    return
+
+def compare(args):
+    "print the times and peak memory from two results files side by side - n/a for steps a version can't do"
+    def load(fn):
+        with open(fn, 'rt') as src:
+            r = json.load(src)
+        return r.get('version', fn), dict(((x['tunes'], x['step']), x) for x in r['results'])
+    va, a = load(args.old)
+    vb, b = load(args.new)
+    print("{0:>6} {1:16} {2:>10} {3:>10} {4:>7} {5:>10} {6:>10}".format("tunes", "step", va[:10], vb[:10], "ratio", "kB", "kB"))
+    for k in sorted(set(a) & set(b), key=lambda k:(k[0], STEPS.index(k[1]) if k[1] in STEPS else 99, k[1])):
+        ta, tb = a[k]['secs'], b[k]['secs']
+        def secs(t):
+            return "{0:10.3f}".format(t) if t is not None else "{0:>10}".format("n/a")
+        ratio = "{0:7.2f}".format(tb/ta) if ta and tb is not None else "{0:>7}".format("-")
+        print("{0:>6} {1:16} {2} {3} {4} {5:>10} {6:>10}".format(k[0], k[1], secs(ta), secs(tb), ratio,
+              (ta is not None and a[k]['maxrss_kb']) or '-', (tb is not None and b[k]['maxrss_kb']) or '-'))
+    return
+
+def main():
+    p = argparse.ArgumentParser(description="benchmarks for the render-ABC tools")
+    sp = p.add_subparsers(dest='cmd', required=True)
+    sx = sp.add_parser('run', help="run the benchmarks")
+    sx.add_argument('-n', '--sizes', type=int, nargs='+', default=SIZES, help="library sizes (tunes)")
+    sx.add_argument('-s', '--steps', nargs='+', choices=STEPS, help="steps to run (default all)")
+    sx.add_argument('-d', '--dir', help="work directory for the libraries and outputs")
+    sx.add_argument('-o', '--output', help="JSON results file")
+    sx.add_argument('-t', '--tree', help="directory with the version of the tools to run (default: this one's)")
+    sx = sp.add_parser('gen', help="write a synthetic ABC library")
+    sx.add_argument('tunes', type=int)
+    sx.add_argument('file')
+    sx.add_argument('--seed', type=int, default=1)
+    sx = sp.add_parser('compare', help="compare two results files")
+    sx.add_argument('old')
+    sx.add_argument('new')
+    sx = sp.add_parser('step') # used by run - one step in a new process
+    sx.add_argument('name')
+    sx.add_argument('file')
+    sx.add_argument('dir')
+    sx.add_argument('tree')
+    args = p.parse_args(sys.argv[1:])
+
+    if args.cmd=='run':
+        run(args)
+    elif args.cmd=='gen':
+        with open(args.file, 'wt') as dst:
+            for l in genlib(args.tunes, args.seed):
+                dst.write(l+'\n')
+    elif args.cmd=='compare':
+        compare(args)
+    elif args.cmd=='step':
+        sys.path[0] = args.tree # the version being measured - instead of this script's directory
+        t = step(args.name, args.file, args.dir)
+        print(json.dumps({'secs':t, 'maxrss_kb':maxrss()}))
+    return
+
+if __name__=="__main__":
+    main()
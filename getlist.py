@@ -3,42 +3,55 @@
 Code to extract a tune/song-list extract CSV file from an ABC library
 
 It expects abcsvg.py set separators.
+
+    python3 getlist.py abcfile outfile.csv
+    python3 getlist.py [-d DIR] abcfiles-or-directories ...
+    python3 getlist.py abcfiles-or-directories ... combined.csv
+The second form writes a CSV file for each library (lib.abc -> lib.csv, beside it or in DIR),
+the third writes one CSV file with a source column. Libraries are scanned in parallel.
+A manifest (in __abccache__ beside each CSV file) remembers the size, mtime, sha256 and the
+scanned sets of each library so unchanged libraries are not scanned again.
 """
 
 import os
+import io
 import re
 import sys
 import csv
+import glob
+import hashlib
+import argparse
+import concurrent.futures
+
+import ABClib
 
 pt=''
+LISTVER = 1 # manifest version - change it when scan() changes
 
-def main():
-    assert len(sys.argv)==3, "usage: "+sys.args[0]+" abcfile outfile.csv"
-    assert sys.argv[2].endswith(".csv"), "Output file must be CSV file (filename ends with .csv)"
+def scan(src):
+    """
+    build a list of sets from the lines of an ABC library (src)
+    each set is a list of tuples with the Xid and the title of the first title in the tune
+    """
+    xid, sets, sx = None, [], []
+    for r in src:
+        rs = r.strip()
+        if any(rs.startswith(sep) for sep in ['%%newpage', "%%sep"]):
+            sets.append(sx)
+            sx =[] # new set - starts as empty
 
-    # build a list of sets
-    # each set is a list of tuples with the Xid and the title of the first title in the tune
+        # strip trailing ABC notation comments
+        cpos = rs.find('%')
+        if cpos>=0:
+            rs = rs[:cpos]
 
-    xid, sets, sx = None, [], []
-    with open(sys.argv[1]) as src:
-        for r in src:
-            rs = r.strip()
-            if any(rs.startswith(sep) for sep in ['%%newpage', "%%sep"]):
-                sets.append(sx)
-                sx =[] # new set - starts as empty
-
-            # strip trailing ABC notation comments
-            cpos = rs.find('%')
-            if cpos>=0:
-                rs = rs[:cpos]
-            
-            # only X: and T: lines matter in this
-            if rs.startswith('X:'):
-                tmp = rs[2:].strip().split()
-                xid = tmp[0] if tmp else None
-            if xid and rs.startswith("T:"): # first T: after non-empty X: 
-                sx.append((xid, rs[2:].strip()))
-                xid = None
+        # only X: and T: lines matter in this
+        if rs.startswith('X:'):
+            tmp = rs[2:].strip().split()
+            xid = tmp[0] if tmp else None
+        if xid and rs.startswith("T:"): # first T: after non-empty X:
+            sx.append((xid, rs[2:].strip()))
+            xid = None
 
     # process last tune/set
     if sx:
@@ -47,20 +60,108 @@ def main():
         else:
             # read an ABC library with no separators
             sets = [[x] for x in sx]
-    
-    if not sets: # error if no tunes/sets found - no output
-        print("no tunes/sets found.")
-        exit(1)
-    
-    # output the CSV file
-    with open(sys.argv[2],"wt") as dstf:
-        dst = csv.writer(dstf, dialect="excel")
-        dst.writerow(("set", "title", "from"+sys.argv[1].rsplit('/',1)[-1]))
-        # xids separated by '-' plus first title
-        dst.writerows(('-'.join(x[0] for x in xs), xs[0][1]) for xs in sets) # force Xids as numbers - start with '
+    return sets
+
+def scanlib(fn, oldsha):
+    """
+    scan ABC library fn - runs in a worker process
+    returns (sha256, sets) - sets is None if the content is unchanged (sha256 is oldsha)
+    """
+    with open(fn, 'rb') as src:
+        data = src.read()
+    h = hashlib.sha256(data).hexdigest()
+    if h==oldsha:
+        return h, None
+    return h, scan(io.TextIOWrapper(io.BytesIO(data)))
+
+def rows(sets):
+    "CSV rows - xids separated by '-' plus first title"
+    return (('-'.join(x[0] for x in xs), xs[0][1]) for xs in sets) # force Xids as numbers - start with '
 
+def libraries(names):
+    "ABC files - directories are searched for *.abc files"
+    fns = []
+    for n in names:
+        fns.extend(sorted(glob.glob(os.path.join(n, '*.abc'))) if os.path.isdir(n) else [n])
+    return fns
+
+def main():
+    p = argparse.ArgumentParser(description="tune/song-list (CSV) of the sets in ABC libraries")
+    p.add_argument('-d', '--dir', help="directory for the CSV file of each library (default: beside the library)")
+    p.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="number of libraries scanned at the same time")
+    p.add_argument('-f', '--force', action='store_true', help="scan and write everything - even if unchanged")
+    p.add_argument('files', nargs='+', help="ABC files or directories - then a CSV file for one combined list")
+    args = p.parse_args(sys.argv[1:])
+
+    names, combined = (args.files[:-1], args.files[-1]) if args.files[-1].endswith(".csv") else (args.files, None)
+    fns = libraries(names)
+    if not fns:
+        p.error("no ABC files")
+    if combined and len(names)==1 and len(fns)==1 and not os.path.isdir(names[0]):
+        outs = {fns[0]:combined} # abcfile outfile.csv - as before - one library, no source column
+        combined = None
+    elif combined:
+        outs = dict((fn, combined) for fn in fns)
+    else:
+        outs = dict((fn, os.path.join(args.dir if args.dir else os.path.dirname(fn), os.path.splitext(os.path.basename(fn))[0]+".csv")) for fn in fns)
+        if args.dir:
+            os.makedirs(args.dir, exist_ok=True)
+
+    # manifests - for each CSV file: {library: ((size, mtime), sha256, sets)}
+    manifests = dict((out, {} if args.force else (ABClib.loadcache(ABClib.cachename(out, '.getlist'), LISTVER) or {})) for out in set(outs.values()))
+    stats = dict((fn, os.stat(fn)) for fn in fns)
+    old = dict((fn, manifests[outs[fn]].get(os.path.abspath(fn))) for fn in fns)
+    def usable(fn):
+        "the manifest entry for fn can be used - its output is there (or there was nothing to output)"
+        return old[fn] and (os.path.isfile(outs[fn]) or not old[fn][2])
+    def unchanged(fn):
+        st = stats[fn]
+        return usable(fn) and old[fn][0]==(st.st_size, st.st_mtime_ns)
+
+    todo = [fn for fn in fns if not unchanged(fn)]
+    changed = set()
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(todo)))) as pool:
+            fs = [pool.submit(scanlib, fn, old[fn][1] if usable(fn) else None) for fn in todo]
+            for fn, f in zip(todo, fs):
+                h, sets = f.result()
+                st = stats[fn]
+                if sets is None: # touched - same content
+                    sets = old[fn][2]
+                else:
+                    changed.add(fn)
+                manifests[outs[fn]][os.path.abspath(fn)] = ((st.st_size, st.st_mtime_ns), h, sets)
+    print(len(fns), "ABC libraries:", len(changed), "scanned,", len(fns)-len(changed), "unchanged")
+
+    failed = False
+    for out in sorted(set(outs.values())):
+        mfns = [os.path.abspath(fn) for fn in fns if outs[fn]==out]
+        dropped = set(manifests[out])-set(mfns)
+        mf = manifests[out] = dict((k, v) for k, v in manifests[out].items() if k in mfns) # only the libraries listed this time
+        for k in mfns:
+            if not mf[k][2]: # error if no tunes/sets found - no output
+                print("no tunes/sets found in", k)
+                failed = True
+        if (os.path.isfile(out) and not dropped and not any(fn in changed for fn in fns if outs[fn]==out)) or not any(mf[k][2] for k in mfns):
+            ABClib.savecache(ABClib.cachename(out, '.getlist'), LISTVER, mf) # nothing new (but mtimes may be)
+            continue
+
+        # output the CSV file
+        with open(out,"wt") as dstf:
+            dst = csv.writer(dstf, dialect="excel")
+            if combined:
+                dst.writerow(("set", "title", "source"))
+                for k in mfns:
+                    dst.writerows(r+(os.path.basename(k),) for r in rows(mf[k][2]))
+            else:
+                dst.writerow(("set", "title", "from"+[fn for fn in fns if outs[fn]==out][0].rsplit('/',1)[-1]))
+                dst.writerows(rows(mf[mfns[0]][2]))
+        print("wrote", out)
+        ABClib.savecache(ABClib.cachename(out, '.getlist'), LISTVER, mf)
+
+    if failed:
+        exit(1)
     return
 
 if __name__=="__main__":
     main()
-        
\ No newline at end of file
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Find tunes by how they start - for when you know the tune but not its name
+
+    python3 incipits.py PBBtunes.abc "GABc dedB"
+    python3 incipits.py -n 20 PBBtunes.abc "|:d2 FA dAFA|"
+
+The query is ABC notes - in any key, and without sharps or flats: the search is by the steps between
+note letters (so a transposed tune is found too). Ranked tunes are printed.
+
+The first bars (BARS) of each tune are turned into notes (ABClib.abcnotes()) and the steps between
+them are indexed by n-grams (NGRAM steps). The index is kept in __abccache__ beside the ABC file
+and made again when the file changes. A query finds the tunes with its n-grams, then ranks them
+by how well the query lines up with the tune - steps first, then rhythm. Shorter queries (a few
+notes) look up their steps in the index too - the tunes where they come earliest are ranked.
+addsvg.py -I puts the same (step) data in a book for its search box - see searchabc.js.
+
+@author: Bob Buckley
+"""
+
+import os
+import sys
+import time
+import array
+import hashlib
+import argparse
+import collections
+
+import ABClib
+
+INCIPITS = 2 # index version - change it when the index (or ABClib.abcnotes()) changes
+BARS = 4 # bars indexed at the start of each tune (a pickup counts as a bar)
+NGRAM = 4 # steps in each n-gram
+
+def intervals(steps):
+    "the steps between notes - as bytes"
+    return bytes((b-a)&0xff for a, b in zip(steps, steps[1:]))
+
+def ngrams(iv, n=NGRAM):
+    "the n-grams in intervals iv"
+    return set(iv[i:i+n] for i in range(len(iv)-n+1))
+
+def ivtext(steps):
+    "the steps between notes as text - one character each (M is no step) - for searchabc.js"
+    return ''.join(chr(77+max(-30, min(30, b-a))) for a, b in zip(steps, steps[1:]))
+
+class Incipits:
+    """
+    n-gram index of the first bars of the tunes in ABC file fn - see above
+    self.tunes is a list of (Xid, title, key, intervals, lengths) and self.grams maps n-grams to tune numbers
+    (for queries shorter than NGRAM steps it also maps shorter n-grams to tune numbers - earliest first)
+    """
+    def __init__(self, fn, cache=True):
+        self.fn, self.cached = fn, False
+        with open(fn, 'rb') as src:
+            data = src.read()
+            st = os.fstat(src.fileno())
+        key = (INCIPITS, BARS, NGRAM, st.st_size, st.st_mtime_ns, hashlib.sha256(data).hexdigest())
+        cfn = ABClib.cachename(fn, '.incipits')
+        cached = ABClib.loadcache(cfn, key) if cache else None
+        if cached:
+            self.tunes, self.grams = cached
+            self.cached = True
+            return
+        self.build(ABClib.Songsets(fn, cache=cache))
+        if cache:
+            ABClib.savecache(cfn, key, (self.tunes, self.grams))
+        return
+
+    def build(self, ss):
+        "index the tunes in Songsets ss"
+        self.tunes, grams, short = [], collections.defaultdict(list), collections.defaultdict(list)
+        for x in ss.abcs():
+            steps, semis, lens = x.notes(BARS)
+            iv = intervals(steps)
+            t = len(self.tunes)
+            for g in ngrams(iv):
+                grams[g].append(t)
+            first = {}
+            for o in range(len(iv)): # where each shorter n-gram first comes
+                for g in (iv[o:o+k] for k in range(1, min(NGRAM, len(iv)-o+1))):
+                    first.setdefault(g, o)
+            for g, o in first.items():
+                short[g].append((o, t))
+            self.tunes.append((x.xid, x.title(fix=True) or '', x.key() or '', iv, lens))
+        self.grams = dict((g, array.array('I', ts)) for g, ts in grams.items())
+        self.grams.update((g, array.array('I', (t for o, t in sorted(ts)))) for g, ts in short.items())
+        return
+
+    def score(self, q, qlens, t):
+        "how well query intervals q (note lengths qlens) line up with tune t - (score, offset)"
+        xid, title, key, iv, lens = self.tunes[t]
+        best = (0, 0)
+        for o in range(max(1, len(iv)-len(q)+1)):
+            steps = sum(a==b for a, b in zip(q, iv[o:]))
+            # rhythm - the same length ratio between each pair of notes
+            rhythm = sum(qlens[i+1]*lens[o+i]==qlens[i]*lens[o+i+1] for i in range(min(len(q), len(lens)-o-1)))
+            s = (steps+0.5*rhythm)/(1.5*len(q))
+            if s>best[0]:
+                best = (s, o)
+        return best
+
+    def find(self, steps, lens, n=10):
+        "the n best tunes for the query notes (see ABClib.abcnotes()) - [(score, offset, tune), ...]"
+        q = intervals(steps)
+        if not q:
+            return []
+        if len(q)>=NGRAM:
+            counts = collections.Counter(t for g in ngrams(q) for t in self.grams.get(g, ()))
+            cands = [t for t, c in counts.most_common(max(200, 4*n))]
+        else: # too short for n-grams - the tunes it comes earliest in
+            cands = self.grams.get(q, array.array('I'))[:max(200, 4*n)]
+        found = [(s, o, t) for s, o, t in ((self.score(q, lens, t)+(t,)) for t in cands)]
+        found.sort(key=lambda e:(-e[0], e[1], e[2])) # best, then nearest the start
+        return found[:n]
+
+def main():
+    p = argparse.ArgumentParser(description="find tunes in an ABC library by their first notes")
+    p.add_argument('-n', '--number', type=int, default=10, help="number of tunes listed (default 10)")
+    p.add_argument('--nocache', action='store_true', help="do not use (or write) the index cache")
+    p.add_argument('file', help="ABC library")
+    p.add_argument('notes', nargs='+', help="ABC notes - e.g. 'GABc dedB'")
+    args = p.parse_args(sys.argv[1:])
+
+    t = time.perf_counter()
+    ix = Incipits(args.file, cache=not args.nocache)
+    print(len(ix.tunes), "tunes", "(index from cache)" if ix.cached else "indexed", "in {0:.0f} ms".format(1000*(time.perf_counter()-t)))
+    steps, semis, lens = ABClib.abcnotes([' '.join(args.notes)])
+    if len(steps)<2:
+        p.error("the query needs at least two notes")
+    t = time.perf_counter()
+    found = ix.find(steps, lens, args.number)
+    print(len(found), "found in {0:.1f} ms".format(1000*(time.perf_counter()-t)))
+    for s, o, n in found:
+        xid, title, key, iv, ln = ix.tunes[n]
+        print("{0:4.0f}% X:{1:6} {2} ({3}){4}".format(100*s, xid, title, key, "" if not o else " - "+str(o)+" notes in"))
+    return
+
+if __name__=="__main__":
+    main()
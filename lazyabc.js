@@ -0,0 +1,93 @@
+// lazyabc.js - render the ABC sets in an addsvg.py --lazy book only when they are needed
+// Sets are in <div class="abcdiv"> with the ABC in <script type="text/vnd.abc-lazy"> (so abcweb doesn't render them)
+// A set is rendered (with the abc2svg/txtmus core) when it comes near the viewport or an index link goes to it.
+// Everything is rendered before printing.
+// A set with a data-abc attribute (abcserve.py) has no ABC in the page - it is fetched from that URL.
+(function () {
+    var hdr = null
+
+    function abctext(div) {
+	if (div.abctxt != null)
+	    return div.abctxt
+	var scr = div.querySelectorAll('script[type="text/vnd.abc-lazy"]'), txt = ""
+	for (var i = 0; i < scr.length; i++)
+	    if (!scr[i].classList.contains("abchdr")) txt += scr[i].textContent
+	return txt
+    }
+
+    function render(div) {
+	if (div.abcdone || typeof abc2svg == "undefined")
+	    return
+	if (div.dataset.abc && div.abctxt == null) {
+	    if (!div.abcfetch)
+		div.abcfetch = fetch(div.dataset.abc).then(function (r) {
+		    if (!r.ok)
+			throw new Error(r.status + " " + r.statusText)
+		    return r.text()
+		}).then(function (t) {
+		    div.abctxt = t
+		    render(div)
+		    if (location.hash == "#" + div.id)
+			div.scrollIntoView()	// an index link went here before it was rendered
+		}).catch(function (e) {
+		    console.log(div.id + ": " + e)
+		    div.abcfetch = null
+		})
+	    return
+	}
+	var txt = hdr + abctext(div), svg = []
+	// abc2svg modules (e.g. %%grid2) are loaded dynamically - render again when they are ready
+	if (abc2svg.modules && !abc2svg.modules.load(txt, function () { render(div) }))
+	    return
+	div.abcdone = true
+	var abc = new abc2svg.Abc({
+		img_out: function (s) { svg.push(s) },
+		errmsg: function (m) { console.log(div.id + ": " + m) },
+		read_file: function () { return "" }
+	})
+	abc.tosvg(div.id, txt)
+	if (abc2svg.abc_end)
+	    abc2svg.abc_end()
+	var out = document.createElement("div")
+	out.className = "abcsvg"
+	out.innerHTML = svg.join("")
+	div.appendChild(out)
+	div.classList.add("abcdone")
+    }
+
+    function gohash() {
+	// index links - render the set, then go there again as the page has changed
+	var div = location.hash && document.getElementById(location.hash.slice(1))
+	if (div && div.classList.contains("abcdiv")) {
+	    render(div)
+	    div.scrollIntoView()
+	}
+    }
+
+    function start() {
+	var h = document.querySelector('script.abchdr[type="text/vnd.abc-lazy"]'),
+	    divs = document.querySelectorAll("div.abcdiv")
+	hdr = h ? h.textContent : ""
+	if ("IntersectionObserver" in window) {
+	    var io = new IntersectionObserver(function (es) {
+		es.forEach(function (e) {
+		    if (e.isIntersecting) {
+			io.unobserve(e.target)
+			render(e.target)
+		    }
+		})
+	    }, { rootMargin: "100% 0px" })	// a screen ahead
+	    divs.forEach(function (d) { io.observe(d) })
+	} else {
+	    divs.forEach(render)
+	}
+	window.addEventListener("hashchange", gohash)
+	window.addEventListener("beforeprint", function () { divs.forEach(render) })
+	gohash()
+    }
+
+    var st = document.createElement("style")	// space for sets that are not rendered yet
+    st.textContent = "div.abcdiv:not(.abcdone) { min-height: 50vh }"
+    document.head.appendChild(st)
+    window.addEventListener("load", start)
+})()
@@ -13,26 +13,53 @@ import os
 import re
 import sys
 import argparse
+import itertools
+import collections
 import datetime as dt
 import base64
-import urllib.request
 
 import bs4
 
-def getsrc(src, embed, mode="rt"):
-    "get external src contents - filename or URL"
-    # always embed files - HTML may get moved and filenames won't work
-    if os.path.isfile(src): # should use URL
-        with open(src, mode=mode) as imgx:
-            data = imgx.read()
-        return True, data
-    elif embed and any(src.startswith(s) for s in ["http://", "https://"]):
-        # url = urllib.request.urlopen(src)
-        with urllib.request.urlopen(src) as urlsrc:
-            data = urlsrc.read().decode()
-        return True, data
-    return False, None
-       
+import assets
+
+ABCSTREAM = '@@abcstream@@' # where the ABC goes in a streamed (-s) document
+
+def fixabc(abc):
+    """
+    fix ABC for a raw book - remove %%newpage, %%sep, empty X:s. T:-
+    returns the ABC and the number of %%newpage/%%sep lines removed
+    """
+    abc = re.sub(r'[\t ]+$', '', abc, flags=re.M) # remove ALL trailing spaces in lines
+    abc, nsep = re.subn(r'^\s*%%(newpage|sep)\b.*\n', '\n', abc, flags=re.M)
+    abc = re.sub(r'^X:\s*\d+\n$', '\n\n', abc, flags=re.M)
+    abc = re.sub(r'^T:\s*-', 'T:', abc, flags=re.M)
+    abc = re.sub(r'\n\n+', '\n\n', abc)
+    return abc, nsep
+
+def abcblocks(src, size=1<<16):
+    """
+    the text of file src in blocks of (at least) size characters - whole lines
+    A block only ends where no fixabc() pattern can match across the break: after a line that is not
+    blank, a number, X:, T: or %..., before a line that does not start with white space, % or X:.
+    """
+    block, n, prev = [], 0, ''
+    for line in src:
+        if n>=size and prev.lstrip()[:1] not in ('', '%') and not prev.strip().isdigit() and not prev.startswith(('X:', 'T:')) and line[:1].strip() not in ('', '%') and not line.startswith('X:'):
+            yield ''.join(block)
+            block, n = [], 0
+        block.append(line)
+        n += len(line)
+        prev = line
+    yield ''.join(block)
+
+def cleanabc(src, stats):
+    "fixabc() for file src a block at a time - the same text as fixabc(src.read())"
+    for block in abcblocks(src):
+        abc, nsep = fixabc(block)
+        stats['seps'] += nsep
+        stats['chars'] += len(abc)
+        yield abc
+
 def main():
     """
     input file x.abc
@@ -53,6 +80,15 @@ def main():
     # p.add_argument("-P", '--pavindex', action='store_true', help="index of singers (%p:v in ABC)")
     # p.add_argument("-d", '--danceindex', action='store_true', help="include 'dance index' for set dance tunes")
     p.add_argument('-o', '--output', help="output/target filename")
+    p.add_argument('--offline', action='store_true', help="only use the local asset cache for URLs - no downloads")
+    p.add_argument('--assetcache', help="asset cache directory (default "+assets.CACHEDIR+")")
+    p.add_argument('--noassetcache', action='store_true', help="always download URLs - don't use the asset cache")
+    p.add_argument('-j', '--jobs', type=int, default=8, help="number of assets fetched at the same time (default 8)")
+    p.add_argument('--timing', action='store_true', help="report the time taken for each embedded asset")
+    p.add_argument('--bundle', help="write embedded files (once, named for their content) to this shared directory instead of embedding them")
+    p.add_argument("-m", '--minify', action='store_true', help="minify embedded Javascript and CSS, and whitespace between tags")
+    p.add_argument("-z", '--precompress', action='append', choices=['gz', 'br'], help="also write a .gz or .br (brotli) copy of the output (repeat for both)")
+    p.add_argument("-s", '--stream', action='store_true', help="fix the ABC a few lines at a time and write it straight to the output - for very large ABC files")
     xgrp = p.add_mutually_exclusive_group()
     xgrp.add_argument("-1", "--abc2svg", action='store_true', help="include abc2svg javascipt")
     xgrp.add_argument("-2", "--txtmus",  action='store_true', help="include txtmus javascipt")
@@ -109,22 +145,18 @@ def main():
         x.string = args.file + " at " + mydate
         print("date string:", x.string)
 
-    print("reading", fnsrc)
-    with open(fnsrc, "rt") as src:
-        abc = src.read()
+    if args.stream:
+        body.div.script.string = ABCSTREAM # the ABC is written when the document is - see cleanabc()
+    else:
+        print("reading", fnsrc)
+        with open(fnsrc, "rt") as src:
+            abc = src.read()
     
-    # fix ABC here
-    # remove %%newpage, %%sep, empty X:s. T:-
-    abc = re.sub(r'[\t ]+$', '', abc, flags=re.M) # remove ALL trailing spaces in lines
-    oldabc = abc
-    abc = re.sub(r'^\s*%%(newpage|sep)\b.*\n', '\n', abc, flags=re.M)
-    if oldabc==abc:
-        print("Remove %%sep and %%newpage failed!!!!!!!!!!!!!!!!!!!!!!!!!")
-    abc = re.sub(r'^X:\s*\d+\n$', '\n\n', abc, flags=re.M)
-    abc = re.sub(r'^T:\s*-', 'T:', abc, flags=re.M)
-    abc = re.sub(r'\n\n+', '\n\n', abc)
+        abc, nsep = fixabc(abc)
+        if not nsep:
+            print("Remove %%sep and %%newpage failed!!!!!!!!!!!!!!!!!!!!!!!!!")
 
-    body.div.script.string = abc
+        body.div.script.string = abc
 
     if args.abc2svg:
         jslist = ["http://moinejf.free.fr/js/abc2svg-1.js", 
@@ -168,6 +200,8 @@ def main():
     #     print("Bad abc2svg or txtmus - js scripts:", [z for z in (x.rsplit('/',1)[-1] for x in doc.head.find_all("script") if x.has_attr("src"))])
     #     exit(1)
 
+    acache = None if args.noassetcache else assets.AssetCache(args.assetcache, offline=args.offline)
+    scripts = []
     for rtag in (x for x in doc.find_all("script") if x.has_attr("src")):
         efn = rtag["src"].rsplit('/', 1)[-1]
         if efn.startswith('snd-'):
@@ -175,30 +209,56 @@ def main():
                 print("embedding snd-?.js does not work (without a local /js directory for all the abs2svg stuff.)")
             if args.playback and args.embed:
                 print("removing", rtag)
-                if rtag: 
-                    rtag.remove()
+                rtag.extract()
                 continue
-        # embed external content and remove src attribute
-        em, txt = getsrc(rtag["src"], args.embed)
-        if em:
-            if any(efn.startswith(fn) for fn in ["abc2svg", "tmcore"]):
-                txt = txt.replace("MIDI:{},", "") # fix loading of MIDI 
+        scripts.append((rtag, (assets.embedjs, rtag["src"], args.embed, acache)))
+    d, fn = os.path.split(args.file)
+    bn, ext = os.path.splitext(fn)
+    target = args.output if args.output else os.path.join(d, bn+".htm")
+    if args.bundle:
+        # shared bundle directory instead of embedding - see assets.bundle()
+        scripts = [(rtag, (assets.bundle, job[1], args.bundle, acache, args.minify, args.embed)) for rtag, job in scripts]
+    # fetch in parallel - then change the document in document order
+    results = assets.fetchall([j for t, j in scripts], args.jobs)
+    for (rtag, job), ((txt, fixmidi), t) in zip(scripts, results):
+        if txt and args.bundle:
+            ref = assets.bundleref(txt, target)
+            print("  Bundle", rtag["src"], "as", ref)
+            rtag["src"] = ref
+        elif txt:
+            # embed external content and remove src attribute
+            if fixmidi:
                 print("fixing MIDI call when emdedding ...")
             print("  Embed script ", rtag["src"])
-            txt = "\n"+txt.replace("'</script>", "'<'+'/script>") # break the string up so HTML loading works
             rtag.append(txt)
             del rtag["src"]
-    del txt
+    if args.timing:
+        assets.report([j[1] for t, j in scripts], results)
+    if acache:
+        print(acache.stats())
 
     # finishing up
-    d, fn = os.path.split(args.file)
-    bn, ext = os.path.splitext(fn)
-    target = args.output if args.output else os.path.join(d, bn+".htm")
+    if args.stream:
+        # the template (head and tail) is small - the ABC goes from the ABC file to the output a block of lines at a time
+        text = str(doc)
+        if args.minify:
+            text = assets.minhtml(text) # the ABC <script> is not changed
+        head, tail = text.split(ABCSTREAM)
+        print("Output sent to", target, "- streaming", fnsrc)
+        stats = collections.Counter()
+        with open(fnsrc, "rt") as src:
+            assets.writestream(target, itertools.chain([head], cleanabc(src, stats), [tail]), precompress=args.precompress or [])
+        if not stats['seps']:
+            print("Remove %%sep and %%newpage failed!!!!!!!!!!!!!!!!!!!!!!!!!")
+        print("<script> length =", stats['chars'])
+        print("Done.")
+        return
+
     print("<script> length =", len(body.div.script.string))
  
     print("Output sent to", target)
-    with open(target, "w") as dst:
-        print(doc, file=dst)    # doc is BeautifulSoup so that does all the work here.
+    # doc is BeautifulSoup so that does all the work here.
+    assets.writebook(target, str(doc), minify=args.minify, precompress=args.precompress or [])
     print("Done.")
     return
 
@@ -0,0 +1,209 @@
+// searchabc.js - the search box for an addsvg.py --search book
+// The index is made by addsvg.py (searchindex()) - JSON in <script type="application/json" id="abcsearch">:
+//   d: tunes [Xid, [titles], key, set id] - in title order (ABClib.sorttitle). The set id (the anchor) is
+//      only there if the tune is not the first in its set - otherwise it is "x"+Xid (as ABCsong.id())
+//   w: sorted words (titles, N: notes and W: words) - p: for each word, the tunes it is in (tune*2+1 for a title word), as deltas
+//   g: trigram -> the words (numbers) with that trigram, as deltas - for misspelt words
+//   i: (addsvg.py -I) for each tune, the steps between its first notes - as incipits.ivtext()
+// Every word must match (a prefix of a word) - if no tune has them all, tunes with some are shown.
+// A search that starts with | is ABC notes (-I) - tunes that start with the same steps between notes.
+// Results show as you type - a result (or Enter for the first one) goes to the set.
+(function () {
+    var ix = null, box, input, list
+
+    function undelta(a) {
+	for (var i = 1; i < a.length; i++)
+	    a[i] += a[i - 1]
+	return a
+    }
+
+    function load() {
+	if (ix)
+	    return ix
+	var s = document.getElementById("abcsearch")
+	ix = JSON.parse(s.textContent)
+	ix.p.forEach(undelta)
+	for (var t in ix.g)
+	    undelta(ix.g[t])
+	ix.x = Object.create(null)	// Xid -> tune
+	ix.d.forEach(function (d, n) { ix.x[d[0]] = n })
+	return ix
+    }
+
+    function words(s) {	// as searchwords() in addsvg.py
+	return s.toLowerCase().normalize("NFKD").replace(/[\u0300-\u036f]/g, "")
+		.split(/[^0-9a-z\u00c0-\u1fff\u2070-\uffff]+/).filter(function (w) { return w })
+    }
+
+    function trigrams(w) {
+	var ts = []
+	for (var i = 0; i + 3 <= w.length; i++)
+	    ts.push(w.substr(i, 3))
+	return ts
+    }
+
+    function first(w) {	// the first word >= w (binary search)
+	var lo = 0, hi = ix.w.length
+	while (lo < hi) {
+	    var mid = (lo + hi) >> 1
+	    if (ix.w[mid] < w)
+		lo = mid + 1
+	    else
+		hi = mid
+	}
+	return lo
+    }
+
+    function term(t, scores) {	// add the tunes that match t to scores (tune -> score)
+	function add(wn, title, text) {
+	    ix.p[wn].forEach(function (v) {
+		var n = v >> 1, s = v & 1 ? title : text
+		if (!(scores[n] >= s))
+		    scores[n] = s
+	    })
+	}
+	if (t in ix.x)
+	    scores[ix.x[t]] = 8	// an Xid
+	var n = 0
+	for (var i = first(t); i < ix.w.length && ix.w[i].lastIndexOf(t, 0) == 0 && n < 300; i++, n++)
+	    add(i, ix.w[i] == t ? 4 : 3, ix.w[i] == t ? 2 : 1)
+	if (n >= 3 || t.length < 4 || /^\d+$/.test(t))
+	    return
+	// misspelt? - words with most of the same trigrams
+	var ts = trigrams(t), common = {}
+	ts.forEach(function (g) {
+	    (ix.g[g] || []).forEach(function (wn) { common[wn] = (common[wn] || 0) + 1 })
+	})
+	for (var wn in common)
+	    if (common[wn] / (ts.length + ix.w[wn].length - 2 - common[wn]) >= 0.4)
+		add(+wn, 1, 0.5)
+    }
+
+    function notestep(n) {	// an ABC note letter with its octave marks -> steps above C
+	return "CDEFGAB".indexOf(n.charAt(0).toUpperCase()) + 7 * ((n >= "a" ? 1 : 0) + n.split("'").length - n.split(",").length)
+    }
+
+    function noteq(q) {	// ABC notes -> the steps between them as text (as incipits.ivtext())
+	var re = /[A-Ga-g][,']*/g, steps, t = ""
+	q = q.replace(/"[^"]*"|![^!]*!|\+[^+]*\+|\{[^}]*\}|\[[A-Za-z]:[^\]]*\]|%.*/g, "")
+	q = q.replace(/\[[^\[\]|]*\]/g, function (c) {	// a chord - only its top note (as ABClib.abcnotes())
+	    return (c.match(re) || []).sort(function (a, b) { return notestep(b) - notestep(a) })[0] || ""
+	})
+	steps = (q.match(re) || []).map(notestep)
+	for (var i = 1; i < steps.length; i++)
+	    t += String.fromCharCode(77 + Math.max(-30, Math.min(30, steps[i] - steps[i - 1])))
+	return t
+    }
+
+    function notesearch(q) {	// tunes whose first notes have the most of the query's 4 step n-grams
+	var t = noteq(q), n = Math.min(4, t.length), grams = [], scores = {}
+	for (var i = 0; n && i + n <= t.length; i++)
+	    if (grams.indexOf(t.substr(i, n)) < 0)
+		grams.push(t.substr(i, n))
+	if (grams.length)
+	    ix.i.forEach(function (s, k) {
+		var c = grams.filter(function (g) { return s.indexOf(g) >= 0 }).length
+		if (c)
+		    scores[k] = c / grams.length + (s.lastIndexOf(t, 0) == 0 ? 1 : s.indexOf(t) >= 0 ? 0.5 : 0)
+	    })
+	var ns = Object.keys(scores).map(Number)
+	ns.sort(function (a, b) { return scores[b] - scores[a] || a - b })
+	return { terms: [], tunes: ns.slice(0, 40) }
+    }
+
+    function search(q) {
+	if (ix.i && /^\s*\|/.test(q))
+	    return notesearch(q)
+	var ts = words(q.replace(/^\s*(an?|the|l[ae]|en)\s+/i, "")), total = null, any = {}	// as ABClib.sorttitle()
+	ts.forEach(function (t) {
+	    var scores = {}
+	    term(t, scores)
+	    for (var n in scores)
+		any[n] = (any[n] || 0) + scores[n]
+	    if (total == null) {
+		total = scores
+		return
+	    }
+	    for (var n in total)	// every word must match
+		if (n in scores)
+		    total[n] += scores[n]
+		else
+		    delete total[n]
+	})
+	if (total && !Object.keys(total).length)
+	    total = any		// nothing has every word - the tunes with some of them
+	var ns = Object.keys(total || {}).map(Number)
+	ns.sort(function (a, b) {
+	    return total[b] - total[a] || a - b	// the tunes are in title order
+	})
+	return { terms: ts, tunes: ns.slice(0, 40) }
+    }
+
+    function title(d, terms) {	// the title that matches most words (an alternate title is shown with the first)
+	var best = 0, most = 0
+	for (var i = 0; i < d[1].length; i++) {
+	    var ws = words(d[1][i]), n = terms.filter(function (t) {
+		return ws.some(function (w) { return w.lastIndexOf(t, 0) == 0 })
+	    }).length
+	    if (n > most) {
+		best = i
+		most = n
+	    }
+	}
+	return best ? d[1][best] + " / " + d[1][0] : d[1][0]
+    }
+
+    function show() {
+	load()
+	var r = search(input.value)
+	list.textContent = ""
+	r.tunes.forEach(function (n) {
+	    var d = ix.d[n], li = document.createElement("li"), a = document.createElement("a")
+	    a.href = "#" + (d[3] || "x" + d[0])
+	    a.textContent = title(d, r.terms) + (d[2] ? " (" + d[2] + ")" : "") + " X:" + d[0]
+	    a.onclick = function () { list.textContent = "" }
+	    li.appendChild(a)
+	    list.appendChild(li)
+	})
+    }
+
+    function start() {
+	var st = document.createElement("style")
+	st.textContent = "#abcsearchbox { position: fixed; top: 0.5em; right: 0.5em; z-index: 10; background: white; max-width: 90vw }\n" +
+	    "#abcsearchbox input { font-size: 1.2em; width: 14em; max-width: 90vw }\n" +
+	    "#abcsearchbox ol { list-style: none; margin: 0; padding: 0 0.3em; max-height: 70vh; overflow-y: auto }\n" +
+	    "#abcsearchbox li a { display: block; padding: 0.3em 0 }\n" +
+	    "@media print { #abcsearchbox { display: none } }"
+	document.head.appendChild(st)
+	box = document.createElement("div")
+	box.id = "abcsearchbox"
+	input = document.createElement("input")
+	input.type = "search"
+	input.placeholder = "Search titles, notes, X:" + (document.getElementById("abcsearch").hasAttribute("data-notes") ? " - |ABC" : "")
+	list = document.createElement("ol")
+	box.appendChild(input)
+	box.appendChild(list)
+	document.body.appendChild(box)
+	var timer = null
+	input.addEventListener("input", function () {	// wait for a pause in typing
+	    clearTimeout(timer)
+	    timer = setTimeout(show, 80)
+	})
+	input.addEventListener("keydown", function (e) {
+	    if (e.key == "Enter" && list.firstChild) {
+		location.hash = list.firstChild.firstChild.getAttribute("href")
+		list.textContent = ""
+		input.blur()
+	    } else if (e.key == "Escape") {
+		input.value = ""
+		list.textContent = ""
+	    }
+	})
+	input.addEventListener("focus", load)
+    }
+
+    if (document.readyState == "loading")
+	document.addEventListener("DOMContentLoaded", start)
+    else
+	start()
+})()